@@ -31,6 +31,8 @@ class App(pyacc.AccCommandLineApp):
         self.parser.add_argument('--no-package', action="store_true", help='Display Agents with no package version')
 
         self.parser.add_argument('--no-summary', action="store_true", help='Do no print summary information')
+        self.parser.add_argument('--summary-only', action="store_true",
+                                 help='Only print summary information, including package version distribution')
 
         self.parser.add_argument('agent_ids', metavar='AGENT_ID', nargs='*', type=str, help='Query the given agent ids')
 
@@ -71,8 +73,16 @@ class App(pyacc.AccCommandLineApp):
             if sort_order:
                 request_params["sort"] = sort_order
 
-            # This will fetch a filtered list of agents a page a time when we iterate over it
-            agents = self.acc.agents(**request_params)
+            if self.args.summary_only:
+                return self.print_summary_table(self.acc.agent_table(**request_params))
+
+            # This will fetch a filtered list of agents a page a time when we iterate over it.
+            # We only print a few fields so use the compact records rather than full Agent objects.
+            agents = self.acc.agents(fields=("serverName", "processName", "agentName", "packageDetails"),
+                                     **request_params).records()
+
+        if self.args.summary_only:
+            return self.print_summary_table(pyacc.AgentTable(agent.get_json() for agent in agents))
 
         if not self.args.ood and not self.args.latest and not self.args.no_package:
             self.args.ood = self.args.latest = self.args.no_package = True
@@ -116,12 +126,38 @@ class App(pyacc.AccCommandLineApp):
                              ]))
 
         if not self.args.no_summary:
-            total = no_package_count + ood_count + latest_count
-            pct = 0
-            if total > 0:
-                pct = (latest_count/float(total)) * 100
+            self.print_summary(no_package_count, ood_count, latest_count)
+
+    def print_summary_table(self, table):
+        """Print the summary from an AgentTable rather than counting agent by agent"""
+
+        no_package_count = table.where("packageId", None).count()
+        latest_count = table.where("packageLatest", True).count()
+        ood_count = table.count() - no_package_count - latest_count
+
+        self.print_summary(no_package_count, ood_count, latest_count)
+
+        print("Agents by package version:\n")
+        print("\t".join(("p-id", "version", "agents", "compliance")))
+
+        with_package = table.where("packageLatest", True, False)
+
+        for package_id in sorted(with_package.group_count("packageId")):
+            package_table = with_package.where("packageId", package_id)
+            latest_versions = package_table.where("packageLatest", True).group_count("packageVersion")
+
+            for version, count in sorted(package_table.group_count("packageVersion").iteritems()):
+                print("\t".join([str(package_id), str(version), str(count),
+                                 "latest" if version in latest_versions else "out of date!"]))
+        print()
+
+    def print_summary(self, no_package_count, ood_count, latest_count):
+        total = no_package_count + ood_count + latest_count
+        pct = 0
+        if total > 0:
+            pct = (latest_count/float(total)) * 100
 
-            print("""
+        print("""
 Agent Package compliance summary:
 
   %d total agents.
@@ -14,10 +14,17 @@ import os
 import sys
 import tarfile
 import re
-import hashlib
+import collections
 import tempfile
+import hashlib
+import heapq
+import operator
+import multiprocessing
+import threading
+import traceback
+import StringIO
 
-from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
 import pyacc
 import bundle_builder
@@ -37,6 +44,30 @@ agent_property_map = {
 }
 
 
+# How a file or property was resolved to a bundle, see AgentArchiverDecomposer.classify_bundles
+INCLUDED = "included"
+CANDIDATE = "candidate"
+AMBIGUOUS = "ambiguous"
+NO_MAPPING = "no mapping"
+
+# Empty files are not matched by content as they would match every bundle with an empty file
+EMPTY_DIGEST = hashlib.sha1().hexdigest()
+
+# Files which might be unknown are copied to memory while being read, or to disk when bigger than this
+SPOOL_SIZE = 4 * 1024 * 1024
+
+# A condition in the agentVersion of a bundle's compatibility, see agent_version_matches
+VERSION_CONDITION_RE = re.compile(r"(>=|<=|==|=|>|<)?\s*(\S+)$")
+VERSION_OPERATORS = {
+    ">=": operator.ge,
+    "<=": operator.le,
+    "==": operator.eq,
+    "=": operator.eq,
+    ">": operator.gt,
+    "<": operator.lt
+}
+
+
 class BundleMappingException(Exception):
     pass
 
@@ -45,13 +76,14 @@ class AmbiguousBundleMappingException(BundleMappingException):
     pass
 
 
-class BundleAlreadyIncludedException(BundleMappingException):
-    def __init__(self, bundle):
-        self.bundle = bundle
+class UnsatisfiableFacetException(BundleMappingException):
+    pass
 
 
-class NoAvailableBundleMappingException(BundleMappingException):
-    pass
+class FacetCycleException(BundleMappingException):
+    def __init__(self, cycle):
+        super(FacetCycleException, self).__init__("Bundle dependency cycle: %s" % " -> ".join(cycle))
+        self.cycle = cycle
 
 
 class BundleIndex(object):
@@ -60,9 +92,17 @@ class BundleIndex(object):
         self.acc = acc
         self.args = args
 
+        # Bundle archives and their file lists are kept in a persistent store (~/.acc/cache/bundles)
+        # so we only download and index bundles we have not seen before.
+        self.store = pyacc.BundleStore(acc)
+
         self.bundle_files = self.fetch_bundles()
 
-    def get_filename_map(self):
+        # The versions of each bundle, sorted (pyacc.BundleVersionIndex)
+        self.versions = pyacc.BundleVersionIndex(self.bundle_files)
+
+    def get_maps(self):
+        """Return the maps of bundle file name to bundles, and of file content digest to bundles"""
         return self.index_bundles(self.bundle_files)
 
     def fetch_bundles(self):
@@ -74,28 +114,29 @@ class BundleIndex(object):
                 bundle.get_json()
                 print(bundle)
 
-            temp_dir = "%s/bundle_temp_%s" % (tempfile.gettempdir(), hashlib.sha1(self.acc.server).hexdigest())
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            bundle.filename = bundle.download(directory=temp_dir)
             bundle_files.append(bundle)
+
+        self.store.sync(bundle_files)
+
         return bundle_files
 
     def index_bundles(self, bundle_files):
         print("\nIndexing bundles:")
         filename_map = {}
+        digest_map = {}
         for bundle in bundle_files:
-            print("\n\t%s:%s (%s)" % (bundle["name"], bundle["version"], bundle.filename))
-            btf = tarfile.open(bundle.filename)
-            for ti in btf.getmembers():
-                if ti.isdir() or ti.name.startswith("metadata/"):
-                    pass
-                else:
-                    print("\t\t%s" % ti.name)
-                    entries = filename_map.setdefault(ti.name, [])
+            print("\t%s:%s (%s)" % (bundle["name"], bundle["version"], self.store.digest(bundle)))
+            for name, digest in self.store.file_digests(bundle):
+                if not name.startswith("metadata/"):
+                    if self.args.verbose:
+                        print("\t\t%s %s" % (digest, name))
+                    entries = filename_map.setdefault(name, [])
                     entries.append(bundle)
-            btf.close()
-        return filename_map
+
+                    if digest and digest != EMPTY_DIGEST:
+                        digest_map.setdefault(digest, []).append(bundle)
+
+        return filename_map, digest_map
 
 
 class PackageUtil(object):
@@ -103,26 +144,34 @@ class PackageUtil(object):
     def __init__(self, new_package):
         self.new_package = new_package
 
+    def compatible(self):
+        return self.new_package.compatible_bundles()
+
+    def required(self):
+        return self.new_package.required_bundles()
+
     def get_compatible_bundles(self):
 
         """
         Build a map of the highest version of the package compatible bundles
         """
 
-        print("\nThese are the compatible bundles for the empty package:")
-        compatible_bundles = {}
-        for bundle in self.new_package.compatible_bundles():
-            print("\t%s:%s" % (bundle["name"], bundle["version"]))
+        return self.latest_versions(pyacc.BundleVersionIndex(self.compatible()))
 
-            exist = compatible_bundles.get(bundle["name"])
+    @staticmethod
+    def latest_versions(versions, accept=None):
+        """
+        Map each bundle name in the BundleVersionIndex to its latest version, or latest accepted version.
+        With accept the versions of each bundle are checked newest first (see BundleVersionIndex.latest).
+        """
 
-            if not exist:
-                compatible_bundles[bundle["name"]] = bundle
-            else:
-                # Select the higher version
-                if LooseVersion(bundle["version"]) > LooseVersion(exist["version"]):
-                    print("\t\tSelecting %s over %s" % (bundle["version"], exist["version"]))
-                    compatible_bundles[bundle["name"]] = bundle
+        print("\nThese are the compatible bundles for the empty package:")
+        compatible_bundles = {}
+        for name in sorted(versions.names()):
+            bundle = versions.latest(name, accept)
+            if bundle:
+                print("\t%s:%s" % (bundle["name"], bundle["version"]))
+                compatible_bundles[name] = bundle
 
         return compatible_bundles
 
@@ -130,69 +179,491 @@ class PackageUtil(object):
 
         print("\nThese are the required bundles:")
         required_bundles = {}
-        for bundle in self.new_package.required_bundles():
+        for bundle in self.required():
             print("\t%s:%s" % (bundle["name"], bundle["version"]))
             required_bundles[bundle["name"]] = bundle
 
         return required_bundles
 
 
-class AgentProfile(object):
-    def __init__(self, fileobj):
-        self.fileobj = fileobj
+def agent_version_matches(version, spec):
+
+    """
+    Whether an agent version (e.g. 10.2) satisfies the agentVersion in the compatibility of a bundle.
+    That is a version, which matches itself and any version it is the start of (10.2 matches 10.2.1, as
+    does 10.*), a comparison (>=10.2), several comparisons separated by commas which must all hold, or
+    an interval such as [10.1,10.4). Anything else matches nothing.
+    """
+
+    spec = (spec or "").strip()
+    if not spec:
+        return True
+
+    v = pyacc.version_key(version)
+
+    if spec[0] in "[(" and spec[-1] in "])":
+        low, _, high = [bound.strip() for bound in spec[1:-1].partition(",")]
+        if low and (v < pyacc.version_key(low) or (spec[0] == "(" and v == pyacc.version_key(low))):
+            return False
+        if high and (v > pyacc.version_key(high) or (spec[-1] == ")" and v == pyacc.version_key(high))):
+            return False
+        return True
+
+    for condition in spec.split(","):
+        match = VERSION_CONDITION_RE.match(condition.strip())
+        if not match:
+            print("\tWARNING: Cannot understand agentVersion %s" % spec)
+            return False
+
+        op, bound = match.groups()
+
+        if not op:
+            prefix = [part for part in bound.split(".") if part not in ("*", "x")]
+            if str(version).split(".")[:len(prefix)] != prefix and v != pyacc.version_key(bound):
+                return False
+        elif not VERSION_OPERATORS[op](v, pyacc.version_key(bound)):
+            return False
+
+    return True
+
+
+class PackagePlanner(PackageUtil):
+
+    """
+    Works out the compatible and required bundles of a new package locally, from the compatibility
+    (agentVersion and osName) and facets of the bundles on the Config Server, rather than by creating
+    a draft package on the Config Server and asking it. This is only an estimate of what the Config
+    Server would say, so it is only used for --plan.
+
+    The required bundles are the bundles providing the facets every package needs and the bundle
+    for the appserver, if there is one. Their dependencies are added by FacetGraph.closure.
+    """
+
+    required_facets = ("java-agent",)
+
+    def __init__(self, bundle_versions, os_name, agent_version, appserver):
+        super(PackagePlanner, self).__init__(None)
+        self.bundle_versions = bundle_versions
+        self.os_name = os_name
+        self.agent_version = agent_version
+        self.appserver = appserver
+        self.compatible_bundles = None
+
+    def is_compatible(self, bundle):
+        compatibility = bundle["compatibility"] or {}
+
+        os_names = compatibility.get("osName")
+        if isinstance(os_names, basestring):
+            os_names = [os_names]
+        if os_names and self.os_name not in os_names:
+            return False
+
+        return agent_version_matches(self.agent_version, compatibility.get("agentVersion"))
+
+    def get_compatible_bundles(self):
+        # Only the versions newer than the latest compatible one need checking
+        self.compatible_bundles = self.latest_versions(self.bundle_versions, self.is_compatible)
+        return self.compatible_bundles
+
+    def required(self):
+        if self.compatible_bundles is None:
+            self.get_compatible_bundles()
+
+        graph = FacetGraph.for_bundles(self.compatible_bundles.values())
+        required = []
+
+        for facet in self.required_facets:
+            try:
+                required.append(graph.provider(facet))
+            except BundleMappingException as e:
+                # Leave it to resolving the dependencies of the other bundles, as creating the package would
+                print("\tWARNING: %s" % e)
+
+        appserver_bundle = self.compatible_bundles.get(self.appserver)
+        if appserver_bundle and appserver_bundle not in required:
+            required.append(appserver_bundle)
+
+        return required
+
+
+class FacetGraph(object):
+
+    """
+    The facet dependency graph over a set of compatible bundles.
+
+    Bundles provide facets and depend on facets provided by other bundles. The map of facet to
+    providing bundles is built once, and the provider chosen for a facet is remembered, so the
+    graph can be shared by all the packages built in one run that have the same compatible bundles
+    (see FacetGraph.for_bundles).
+    """
+
+    # frozenset of compatible bundle ids -> FacetGraph
+    _graphs = {}
+
+    @classmethod
+    def for_bundles(cls, compatible_bundles):
+        key = frozenset(bundle["id"] for bundle in compatible_bundles)
+        graph = cls._graphs.get(key)
+        if not graph:
+            graph = cls._graphs[key] = cls(compatible_bundles)
+        return graph
+
+    def __init__(self, compatible_bundles):
+
+        # facet -> compatible bundles that provide it, ordered by name
+        self.providers = {}
+        for bundle in sorted(compatible_bundles, key=lambda b: b["name"]):
+            for facet in bundle["facets"]:
+                self.providers.setdefault(facet, []).append(bundle)
+
+        # facet -> the compatible bundle chosen to provide it
+        self.chosen = {}
+
+        # frozenset of (name, version) of a bundle set -> the bundles its closure adds
+        self.closures = {}
+
+    def provider(self, facet):
+        """The unique compatible bundle providing facet"""
+
+        bundle = self.chosen.get(facet)
+        if bundle:
+            return bundle
+
+        providers = self.providers.get(facet)
+
+        if not providers:
+            raise UnsatisfiableFacetException("No compatible bundle provides %s" % facet)
+
+        if len(providers) > 1:
+            raise AmbiguousBundleMappingException("%s is provided by multiple compatible bundles: %s" % (
+                facet, ", ".join("%s:%s" % (b["name"], b["version"]) for b in providers)))
+
+        bundle = self.chosen[facet] = providers[0]
+        return bundle
+
+    def closure(self, bundles):
+
+        """
+        Work out which compatible bundles need to be added to bundles (a map of name to bundle)
+        to satisfy all their dependencies, including the dependencies of the added bundles.
+        Returns a list of (bundle, facet, dependent) tuples for the additions, in the order they were found.
+        """
+
+        key = frozenset((b["name"], b["version"]) for b in bundles.itervalues())
+        additions = self.closures.get(key)
+        if additions is not None:
+            return additions
+
+        provided = set(facet for bundle in bundles.itervalues() for facet in bundle["facets"])
+        names = set(bundles)
+        additions = []
+
+        worklist = collections.deque(sorted(bundles.itervalues(), key=lambda b: b["name"]))
+
+        while worklist:
+            bundle = worklist.popleft()
+
+            for facet in bundle["dependencies"]:
+                if facet in provided:
+                    continue
+
+                candidate = self.provider(facet)
+
+                if candidate["name"] in names:
+                    raise BundleMappingException("%s needs %s from %s:%s but a different version of %s is included" % (
+                        bundle["name"], facet, candidate["name"], candidate["version"], candidate["name"]))
+
+                names.add(candidate["name"])
+                provided.update(candidate["facets"])
+                additions.append((candidate, facet, bundle))
+                worklist.append(candidate)
+
+        self.closures[key] = additions
+        return additions
+
+    def order(self, bundles):
+
+        """
+        Sort bundles (a map of name to bundle) so that each bundle comes after the bundles it
+        depends on. Bundles with no ordering between them are sorted by name.
+        Raises FacetCycleException if the bundles depend on each other in a cycle.
+        """
+
+        # facet -> names of the bundles in the set that provide it
+        providers = {}
+        for name, bundle in bundles.iteritems():
+            for facet in bundle["facets"]:
+                providers.setdefault(facet, set()).add(name)
+
+        depends_on = {}
+        dependents = dict((name, set()) for name in bundles)
+        for name, bundle in bundles.iteritems():
+            depends_on[name] = set(dep for facet in bundle["dependencies"]
+                                   for dep in providers.get(facet, ()) if dep != name)
+            for dep in depends_on[name]:
+                dependents[dep].add(name)
+
+        waiting = dict((name, len(deps)) for name, deps in depends_on.iteritems())
+        ready = [name for name, count in waiting.iteritems() if count == 0]
+        heapq.heapify(ready)
+
+        ordered = []
+        while ready:
+            name = heapq.heappop(ready)
+            ordered.append(bundles[name])
+            for dependent in dependents[name]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    heapq.heappush(ready, dependent)
+
+        if len(ordered) < len(bundles):
+            raise FacetCycleException(self._find_cycle(depends_on, set(n for n, count in waiting.iteritems() if count)))
+
+        return ordered
+
+    @staticmethod
+    def _find_cycle(depends_on, remaining):
+        # Every bundle left over depends on another left over bundle, so walking
+        # the dependencies must come back round to a bundle already seen
+        path = []
+        name = min(remaining)
+        while name not in path:
+            path.append(name)
+            name = min(dep for dep in depends_on[name] if dep in remaining)
+        return path[path.index(name):] + [name]
+
+
+class AgentArchiveAnalysis(object):
+
+    """
+    The content of an agent archive: the properties from its profiles and toggles files, and
+    which bundle file each of its files corresponds to. Files which are not in any bundle
+    are put in a new local bundle (unknown_tar_name).
+
+    This only needs the set of bundle file paths, not the server, so that many archives can
+    be analyzed in a process pool (see analyze_agent_archive).
+
+    The archive is read in a single pass as a stream, so each entry is decompressed once and
+    can only be read once: profiles are parsed, files are hashed and the content of files which
+    might not be in any bundle is kept aside in case they need to go in the new bundle.
+    """
+
+    def __init__(self, agent_archive):
+        self.agent_archive = agent_archive
+
+        # (hidden, name, value) for each property, in the order they were found
+        self.properties = []
+
+        # (archive filename, bundle filename, digest of content) for each file we have a bundle for
+        self.files = []
+
+        self.warnings = 0
+        self.unknown_tar_name = None
+
+    def _agent_archive_entries(self):
+        """Loop over each file in the archive"""
+        with tarfile.open(self.agent_archive, "r|*") as atf:
+            for ti in atf:
+                if ti.isdir():
+                    pass
+                else:
+                    yield atf, ti
+
+    def include_toggles(self, name, include_toggles):
+
+        # Importing toggles-full.pbd could be a bad idea as it will switch everything on
+        if name == "wily/core/config/acc-master-toggles.pbd" or include_toggles:
+            return True
+
+        print("\tDo you wish to include the content of toggles file: %s" % name)
+
+        if include_toggles is None:
+            return raw_input("y/N: ") == "y"
+
+        print("\tNo, use --yes to include it")
+        return False
+
+    def _read_properties(self, fileobj, toggles=False):
+        """Add the properties of a profile or toggles file, see pyacc.read_properties_file"""
+        properties, warnings = pyacc.read_properties_file(fileobj, toggles)
+
+        for warning in warnings:
+            print("\tWARNING: %s" % warning)
+        self.warnings += len(warnings)
+
+        self.properties.extend((False, name, value) for name, value in properties)
+
+    @staticmethod
+    def _read_entry(atf, ti, spool=None):
+        """Return the digest of the content of the current entry, copying the content to spool if given"""
+        fileobj = atf.extractfile(ti)
+        sha1 = hashlib.sha1()
+        for chunk in iter(lambda: fileobj.read(1048576), ""):
+            sha1.update(chunk)
+            if spool:
+                spool.write(chunk)
+        return sha1.hexdigest()
+
+    def analyze(self, known_paths, known_digests, include_toggles=None):
+
+        """
+        Read the agent archive. known_paths is the collection of files that are in bundles,
+        and known_digests the digests of their content. include_toggles says whether to
+        include toggles files other than the acc-master one, None meaning ask.
+        """
+
+        print("\nAnalyzing Agent Package: %s" % self.agent_archive)
+
+        bundle_missing = None
+
+        for atf, ti in self._agent_archive_entries():
+
+            if ti.name.endswith(".profile"):
+                print("\tFound profile:", ti.name)
+                self._read_properties(atf.extractfile(ti))
+
+            elif "toggle" in ti.name:
+
+                if self.include_toggles(ti.name, include_toggles):
+                    self._read_properties(atf.extractfile(ti), toggles=True)
+                else:
+                    print("skipping import of toggles from %s" % ti.name)
 
-    def properties(self):
-        for raw in self.fileobj:
-            line = raw.strip()
-            if not line or line[0] == "#":
-                pass
-            else:
-                try:
-                    prop_split = App.val_re.split(line)
-                    hidden = prop_split[1] == "#"
-                    name = prop_split[2].strip()
-                    value = prop_split[3].strip()
-
-                    yield hidden, name, value
-                except IndexError as e:
-                    print("Failed to process", line.strip())
-
-
-class AgentToggles(object):
-    def __init__(self, fileobj):
-        self.fileobj = fileobj
-
-    def properties(self):
-        # TurnOn: ServerInfoTracing
-        for raw in self.fileobj:
-            line = raw.strip()
-            if not line or line[0] == "#":
-                pass
-            elif line.startswith("InstrumentPoint:"):
-                pass
-            elif line.startswith("TurnOn: "):
-                try:
-                    name = "instrument.%s" % line.split(" ", 1)[1]
-                    yield False, name, "on"
-                except IndexError as e:
-                    print("Failed to process", line.strip())
             else:
-                raise Exception("Not sure what this is in toggles file: " + line)
+                # Check if a mapping exists. Some files are mapped to None which means ignore them
+                # and don't try and add them to the package
+                if ti.name not in agent_file_map:
+                    bundle_path = ti.name
+                else:
+                    bundle_path = agent_file_map[ti.name]
+                    if not bundle_path:
+                        print("\tIgnoring file: %s" % ti.name)
+                        continue
+
+                known_path = bundle_path in known_paths
+
+                # This is the only chance to read the content, so keep a copy if we might need it
+                spool = None if known_path or not ti.isfile() else tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+                digest = self._read_entry(atf, ti, spool) if ti.isfile() and ti.size else None
+
+                if not known_path and digest not in known_digests:
+                    print("\tWARNING: No bundle mapping for: %s" % (ti.name))
+                    self.warnings += 1
+
+                    if not bundle_missing:
+                        name = "%s-unknown-files" % os.path.splitext(os.path.basename(self.agent_archive))[0]
+                        bundle_missing = bundle_builder.BundleBuilder(name, force_overwrite_existing=True)
+
+                    if spool:
+                        spool.seek(0)
+
+                    bundle_missing.add_tarinfo_entry(atf, ti, spool)
+                else:
+                    self.files.append((ti.name, bundle_path, digest))
+
+                if spool:
+                    spool.close()
+
+        if bundle_missing:
+            bundle_missing.close()
+            self.unknown_tar_name = bundle_missing.tar_name
+
+        return self
+
+
+# The bundle file paths and content digests, set in each process of the pool by init_analyze_worker
+known_bundle_paths = None
+known_bundle_digests = None
+
+
+def init_analyze_worker(paths, digests):
+    global known_bundle_paths, known_bundle_digests
+    known_bundle_paths = frozenset(paths)
+    known_bundle_digests = frozenset(digests)
+
+
+def analyze_agent_archive(agent_archive, include_toggles):
+    """
+    Analyze an agent archive in a pool process, returning the analysis and what it printed
+    """
+    sys.stdout = output = StringIO.StringIO()
+    try:
+        analysis = AgentArchiveAnalysis(agent_archive).analyze(known_bundle_paths, known_bundle_digests, include_toggles)
+        return analysis, output.getvalue()
+    finally:
+        sys.stdout = sys.__stdout__
+
+
+class ThreadOutput(object):
+
+    """
+    A replacement for sys.stdout which lets a thread collect what it prints, so the
+    output of packages being built concurrently is not interleaved.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def capture(self):
+        self.local.buffer = StringIO.StringIO()
+
+    def release(self):
+        """Stop capturing and print what the thread captured in one go"""
+        buffer = self.local.buffer
+        self.local.buffer = None
+        with self.lock:
+            self.stream.write(buffer.getvalue())
+            self.stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is not None:
+            buffer.write(text)
+        else:
+            with self.lock:
+                self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
 
 class AgentArchiverDecomposer(object):
 
-    def __init__(self, acc, args, agent_archive, filename_map):
+    def __init__(self, acc, args, agent_archive, filename_map, digest_map, bundle_versions, property_index):
         self.acc = acc
         self.args = args
 
+        # The versions of all the bundles on the Config Server, which the package is planned from (see PackagePlanner)
+        self.bundle_versions = bundle_versions
+
+        # Persistent index of the properties of bundles (pyacc.BundlePropertyIndex)
+        self.property_index = property_index
+
         self.agent_archive = agent_archive
+
+        # Maps of bundle file name, and of the digest of the file content, to the bundles with that file
         self.filename_map = filename_map
+        self.digest_map = digest_map
 
         self.warnings = 0
 
         self.new_package = None
+        self.package_edit = None
+
+        # The overrides for the package, worked out before it is created
+        self.bundle_overrides = {}
+        self.overrides = pyacc.OverrideSet(self.bundle_overrides)
 
-        self.bundle_missing = None
+        # The bundles for the package, dependencies first
+        self.planned_bundles = None
+
+        # The local bundle created for files which are not in any bundle, if there were any
+        self.unknown_tar_name = None
+
+        self.override_count = 0
 
         # A map of of properties in the archive to bundles that have the property
         self.archive_property_to_bundles = {}
@@ -215,6 +686,9 @@ class AgentArchiverDecomposer(object):
         # A list of bundles we are going to add to the Package, initialised to the required bundles.
         self.included_bundles = None
 
+        # The dependency graph of the compatible bundles (FacetGraph)
+        self.facet_graph = None
+
         # A map of properties to (compatible) bundles
         self.bundle_property_map = {}
         # self.hidden_bundle_property_map = {}
@@ -228,13 +702,13 @@ class AgentArchiverDecomposer(object):
         """
 
         print("\nReading properties for compatible bundles:")
+
         for bundle in compatible_bundles:
             bundle.profile_property_map = {}
 
             print("\t%s:%s" % (bundle["name"], bundle["version"]))
-            profile = bundle.profile()
 
-            for prop in profile["properties"] or []:
+            for prop in self.property_index.properties(bundle):
 
                 print("\t\t%s%s=%s" % ("#" if prop["hidden"] else "", prop["name"], prop["value"]))
 
@@ -252,29 +726,49 @@ class AgentArchiverDecomposer(object):
 
                     bundle.profile_property_map[prop["name"]] = prop
 
-    def create_package_from_archive(self):
+    def create_package_from_archive(self, get_analysis=None):
 
-        print("\nCreating empty package:")
+        """
+        Create the package, or only work out and print what it would contain (--plan).
+        get_analysis is a function returning the AgentArchiveAnalysis of the archive, if it is being
+        analyzed elsewhere.
 
-        v2 = ".".join(self.args.agent_version.split(".")[0:2])
+        The Config Server decides which bundles a package requires and which are compatible, which it
+        can only say for a package it has, so a draft package is created first to ask it. With --plan
+        nothing is created and the PackagePlanner works out the bundles itself instead.
+        """
 
-        # Create draft package. This enables us to get the required/compatible/includes list of bundles
-        self.new_package = self.acc.package_create(name=os.path.basename(self.agent_archive),
-                                                   os=self.args.os,
-                                                   appserver=self.args.appserver,
-                                                   em_host=self.args.em_host,
-                                                   process_display_name="process display name",
-                                                   agent_version=v2,
-                                                   comment="Package generated from Agent archive " +
-                                                           os.path.basename(self.agent_archive), draft=True)
-        print(self.new_package)
+        if self.args.plan:
+            self.plan_package(PackagePlanner(self.bundle_versions, self.args.os, self.agent_version(),
+                                             self.args.appserver), get_analysis)
+            self.print_plan()
+        else:
+            self.create_draft_package()
+            self.plan_package(PackageUtil(self.new_package), get_analysis)
+            self.create_package()
+
+    def plan_package(self, package_util, get_analysis=None):
 
-        self.compatible_bundles = PackageUtil(self.new_package).get_compatible_bundles()
-        self.included_bundles = PackageUtil(self.new_package).get_required_bundles()
+        """
+        Work out the bundles and overrides the package needs, starting from the compatible and
+        required bundles given by package_util (a PackageUtil or PackagePlanner). Nothing is changed
+        on the Config Server.
+        """
+
+        print("\nPlanning package:")
+
+        self.compatible_bundles = package_util.get_compatible_bundles()
+        self.included_bundles = package_util.get_required_bundles()
+        self.facet_graph = FacetGraph.for_bundles(self.compatible_bundles.values())
+
+        # Fetch the properties of all the bundles we might use up front, concurrently.
+        # Every later step then reads them from the property index rather than the server.
+        print("\nPrefetching bundle properties:")
+        self.property_index.refresh(self.compatible_bundles.values() + self.included_bundles.values())
 
         self._build_bundle_property_map(self.compatible_bundles.values())
 
-        self.process_agent_archive()
+        self.process_agent_archive(get_analysis and get_analysis())
 
         # Pick bundles for the files we have
         self.resolve_bundles(["file", "files"], self.included_filename_map)
@@ -290,80 +784,106 @@ class AgentArchiverDecomposer(object):
         # Resolve remaining dependencies
         self.resolve_dependencies()
 
-        override_count = self.create_overrides()
-        override_count += self.create_overrides_to_hide_extra_properties()
+        self.override_count = self.create_overrides()
+        self.override_count += self.create_overrides_to_hide_extra_properties()
 
-        # Now add the bundles we selected to the package
-        self.add_bundles_to_package(self.included_bundles.values())
+        # The bundles will be added to the package dependencies first
+        try:
+            self.planned_bundles = self.facet_graph.order(self.included_bundles)
+        except FacetCycleException as e:
+            print("\nWARNING: %s" % e)
+            self.planned_bundles = [self.included_bundles[name] for name in sorted(self.included_bundles)]
 
-        # Add the overrides TODO really want to do this as part of the same patch, rather than 2 patches
-        if override_count > 0:
-            print("\nAdding %d overrides" % override_count)
-            self.new_package.add_overrides(self.new_package["bundleOverrides"])
+    def agent_version(self):
+        return ".".join(self.args.agent_version.split(".")[0:2])
 
-    def _agent_archive_entries(self):
-        """Loop over each file in the archive"""
-        with tarfile.open(self.agent_archive) as atf:
-            for ti in atf:
-                if ti.isdir():
-                    pass
-                else:
-                    yield atf, ti
+    def print_plan(self):
 
-    def process_agent_archive(self):
-        """
-        Read the agent archive
-        """
+        print("\nPackage plan for %s (%s, %s, agent version %s):" % (
+            os.path.basename(self.agent_archive), self.args.os, self.args.appserver, self.agent_version()))
 
-        print("\nAnalyzing Agent Package: %s" % self.agent_archive)
-        for atf, ti in self._agent_archive_entries():
+        print("\n\tBundles:")
+        for bundle in self.planned_bundles:
+            print("\t\t%s:%s" % (bundle["name"], bundle["version"]))
 
-            if ti.name.endswith(".profile"):
-                print("\tFound profile:", ti.name)
-                for hidden, name, value in AgentProfile(atf.extractfile(ti)).properties():
-                    self.register_archive_property(hidden, name, value)
+        print("\n\tOverrides:")
+        for bundle_name, overrides in sorted(self.bundle_overrides.iteritems()):
+            for prop in overrides["properties"]:
+                print("\t\t%s: %s%s=%s" % (bundle_name, "#" if prop["hidden"] else "", prop["name"], prop["value"]))
 
-            elif "toggle" in ti.name:
+    def create_draft_package(self):
 
-                # Importing toggles-full.pbd could be a bad idea as it will switch everything on
+        """Create an empty draft package, which the bundles and overrides are added to once planned"""
 
-                print("\tDo you wish to include the content of toggles file: %s" % ti.name)
+        print("\nCreating empty package:")
 
-                ans = "y" if ti.name == "wily/core/config/acc-master-toggles.pbd" or self.args.yes else raw_input("y/N: ")
+        self.new_package = self.acc.package_create(name=os.path.basename(self.agent_archive),
+                                                   os=self.args.os,
+                                                   appserver=self.args.appserver,
+                                                   em_host=self.args.em_host,
+                                                   process_display_name="process display name",
+                                                   agent_version=self.agent_version(),
+                                                   comment="Package generated from Agent archive " +
+                                                           os.path.basename(self.agent_archive), draft=True)
+        print(self.new_package)
 
-                if ans == "y":
-                    for hidden, name, value in AgentToggles(atf.extractfile(ti)).properties():
-                        self.register_archive_property(hidden, name, value)
-                else:
-                    print("skipping import of toggles from %s" % ti.name)
+    def create_package(self):
 
-            else:
-                # Check if a mapping exists. Some files are mapped to None which means ignore them
-                # and don't try and add them to the package
-                if ti.name not in agent_file_map:
-                    entries = self.filename_map.get(ti.name)
-                else:
-                    map_dest = agent_file_map[ti.name]
-                    if not map_dest:
-                        print("\tIgnoring file: %s" % ti.name)
-                        continue
-                    entries = self.filename_map.get(map_dest)
+        """Add the planned bundles and overrides to the draft package in a single request"""
 
-                if not entries:
-                    print("\tWARNING: No bundle mapping for: %s" % (ti.name))
-                    self.warnings += 1
+        print("\nCreating package:")
 
-                    if not self.bundle_missing:
-                        name = "%s-unknown-files" % os.path.splitext(os.path.basename(self.agent_archive))[0]
-                        self.bundle_missing = bundle_builder.BundleBuilder(name, force_overwrite_existing=True)
+        self.package_edit = self.new_package.edit()
+        self.package_edit.bundle_overrides = self.bundle_overrides
 
-                    self.bundle_missing.add_tarinfo_entry(atf, ti)
-                else:
-                    print("\t%s : Provided by: %s" % (ti.name, ["%s:%s" % (x["name"], x["version"]) for x in entries or []]))
-                    self.included_filename_map[ti.name] = entries
+        self.add_bundles_to_package(self.planned_bundles)
+
+        if self.override_count > 0:
+            print("\nAdding %d overrides" % self.override_count)
+
+        # The package was only a draft while we added to it
+        self.package_edit.set_draft(False)
+        self.package_edit.apply()
+
+    def process_agent_archive(self, analysis=None):
+        """
+        Look up the files and properties of the agent archive in the bundles
+        """
+
+        if not analysis:
+            analysis = AgentArchiveAnalysis(self.agent_archive)
+            analysis.analyze(self.filename_map, self.digest_map, True if self.args.yes else None)
+
+        self.warnings += analysis.warnings
+        self.unknown_tar_name = analysis.unknown_tar_name
+
+        for hidden, name, value in analysis.properties:
+            self.register_archive_property(hidden, name, value)
+
+        print("\nLooking up files in bundles:")
+        for name, bundle_path, digest in analysis.files:
+            entries = self.lookup_file(bundle_path, digest)
+            print("\t%s : Provided by: %s" % (name, ["%s:%s" % (x["name"], x["version"]) for x in entries]))
+            self.included_filename_map[name] = entries
+
+    def lookup_file(self, bundle_path, digest):
+
+        """
+        Return the bundles that could provide a file. Bundles with exactly the same content
+        are preferred, then those of them with the file at the same path, so a file which has
+        been renamed or moved is still found and different versions of a file are told apart.
+        Only if no bundle has the same content do we go by the path alone.
+        """
+
+        by_path = self.filename_map.get(bundle_path, [])
+        by_digest = self.digest_map.get(digest)
 
-        if self.bundle_missing:
-            self.bundle_missing.close()
+        if not by_digest:
+            return by_path
+
+        same_path = [bundle for bundle in by_digest if bundle in by_path]
+
+        return same_path or by_digest
 
     def register_archive_property(self, hidden, name, value):
 
@@ -410,99 +930,101 @@ class AgentArchiverDecomposer(object):
 
     def resolve_bundles(self, mapping_type, included_filename_map):
 
-        """Resolve files or properties to the bundle they belong to"""
+        """
+        Resolve files or properties to the bundle they belong to.
 
-        bundle_map = {}
+        If there is ambiguity for a certain file or property we defer its resolution until
+        a bundle it could come from has been added to the package. An index of bundle name to
+        the deferred items it could provide means only the items affected by a newly added
+        bundle are looked at again, rather than rescanning everything.
+        """
 
-        # Add bundles from files
-        for i in range(len(included_filename_map)):
+        print("\nMapping %s to bundles" % mapping_type[1])
 
-            print("\nMapping %s to bundles, iteration %d" % (mapping_type[1], i))
+        bundle_map = {}
 
-            # Keep looping trying to uniquely resolve the files of the agent archive to
-            # bundles.  If there is ambiguity for a certain file, we defer resolution and
-            # continue and try and resolve it afterwards whereby a bundle may have since been
-            # added which provides the uncertain file.
-            remaining = added = no_mapping = mapped = 0
+        # Items we could not resolve (yet), and the reason
+        unresolved = {}
 
-            for filename_or_property, entries in included_filename_map.iteritems():
+        # bundle name -> unresolved items which that bundle could provide
+        waiting_on = {}
 
-                try:
-                    candidate = self.choose_bundle(entries)
+        worklist = collections.deque(included_filename_map)
 
-                    # Add the matched bundle to the included bundles list
-                    print("\tAdding Bundle %s:%s to Package due to %s %s" % (candidate["name"], candidate["version"], mapping_type[0], filename_or_property))
-                    self.included_bundles[candidate["name"]] = candidate
+        while worklist:
+            filename_or_property = worklist.popleft()
 
-                    bundle_map[filename_or_property] = candidate
+            if filename_or_property in bundle_map:
+                continue
 
-                    added += 1
+            entries = included_filename_map[filename_or_property]
+            resolution, bundle = self.classify_bundles(entries)
 
-                except BundleAlreadyIncludedException as e:
-                    bundle_map[filename_or_property] = e.bundle
-                    mapped += 1
-                except NoAvailableBundleMappingException:
-                    no_mapping += 1
-                except AmbiguousBundleMappingException:
-                    print("\tCould not resolve %s %s to a unique bundle (yet)" % (mapping_type[0], filename_or_property))
-                    remaining += 1
+            if resolution == INCLUDED:
+                bundle_map[filename_or_property] = bundle
+                unresolved.pop(filename_or_property, None)
 
-            if remaining == 0:
-                # Nothing left to resolve
-                print("%d %s successfully mapped to bundles. %d remain unmapped" % (mapped, mapping_type[1], no_mapping))
-                break
+            elif resolution == CANDIDATE:
+                # Add the matched bundle to the included bundles list
+                print("\tAdding Bundle %s:%s to Package due to %s %s" % (bundle["name"], bundle["version"], mapping_type[0], filename_or_property))
+                self.included_bundles[bundle["name"]] = bundle
 
-            if added == 0:
-                raise AmbiguousBundleMappingException("Could not satisfactorily resolve some %s to a bundle" % (mapping_type[1]))
+                bundle_map[filename_or_property] = bundle
+                unresolved.pop(filename_or_property, None)
 
-            print("Have %d %s that could not resolve to a bundle on iteration %d" % (remaining, mapping_type[1], i))
+                # Have another look at anything the new bundle could provide
+                worklist.extend(waiting_on.pop(bundle["name"], []))
 
-        return bundle_map
+            else:
+                if resolution == AMBIGUOUS:
+                    print("\tCould not resolve %s %s to a unique bundle (yet)" % (mapping_type[0], filename_or_property))
 
-    def resolve_dependencies(self):
-        print("\nResolve remaining dependencies for Package\n")
+                if filename_or_property not in unresolved:
+                    for entry in entries:
+                        waiting_on.setdefault(entry["name"], []).append(filename_or_property)
 
-        facets_included_map = {}
-        for bundle in self.included_bundles.values():
-            for facet in bundle["facets"]:
-                facets_included_map.setdefault(facet, []).append(bundle)
+                unresolved[filename_or_property] = resolution
 
-        facets_compatible_map = {}
-        for bundle in self.compatible_bundles.values():
-            for facet in bundle["facets"]:
-                facets_compatible_map.setdefault(facet, []).append(bundle)
+        no_mapping = [x for x, resolution in unresolved.iteritems() if resolution == NO_MAPPING]
+        ambiguous = sorted(x for x, resolution in unresolved.iteritems() if resolution == AMBIGUOUS)
 
-        for bundle in self.included_bundles.values():
-            self.resolve_dependency_recursive(facets_included_map, facets_compatible_map, bundle)
+        if ambiguous:
+            print("Could not resolve these %s to a unique bundle:" % mapping_type[1])
+            for filename_or_property in ambiguous:
+                print("\t%s (%s)" % (filename_or_property, ["%s:%s" % (x["name"], x["version"]) for x in included_filename_map[filename_or_property]]))
 
-    def resolve_dependency_recursive(self, facets_included_map, facets_compatible_map, bundle):
+            raise AmbiguousBundleMappingException("Could not satisfactorily resolve %d %s to a bundle: %s" % (
+                len(ambiguous), mapping_type[1], ", ".join(ambiguous)))
 
-        print("Bundle %s" % bundle["name"])
+        print("%d %s successfully mapped to bundles. %d remain unmapped" % (len(bundle_map), mapping_type[1], len(no_mapping)))
 
-        for dep in bundle["dependencies"]:
+        return bundle_map
 
-            dep_implemented_by = facets_included_map.get(dep)
+    def resolve_dependencies(self):
 
-            if not dep_implemented_by:
+        """Add the compatible bundles needed to satisfy the dependencies of the included bundles"""
 
-                # Search compatible bundles for that one
-                entries = facets_compatible_map.get(dep)
+        print("\nResolve remaining dependencies for Package\n")
 
-                candidate = self.choose_bundle(entries)
+        additions = self.facet_graph.closure(self.included_bundles)
 
-                print("\tNeed to additionally include %s:%s" % (candidate["name"], candidate["version"]))
-                self.included_bundles[candidate["name"]] = candidate
+        for bundle, facet, dependent in additions:
+            print("\tNeed to additionally include %s:%s for %s needed by %s" % (bundle["name"], bundle["version"], facet, dependent["name"]))
+            self.included_bundles[bundle["name"]] = bundle
 
-                for facet in candidate["facets"]:
-                    facets_included_map.setdefault(facet, []).append(candidate)
+        if not additions:
+            print("\tAll dependencies are satisfied")
 
-                # Now recurse for the one we added
-                self.resolve_dependency_recursive(facets_included_map, facets_compatible_map, candidate)
-            else:
-                dep_implemented_by = [b["name"] for b in dep_implemented_by]
-                print("\tdepends on: %s which is provided by: %s" % (dep, dep_implemented_by))
+    def classify_bundles(self, entries):
+        """
+        Work out which of the bundles that could provide a file or property to use.
+        Returns a tuple of the resolution and the bundle:
 
-    def choose_bundle(self, entries):
+            INCLUDED, bundle - a bundle of that name is already in the package
+            CANDIDATE, bundle - the only compatible bundle, which is not in the package yet
+            AMBIGUOUS, None - more than one compatible bundle
+            NO_MAPPING, None - no compatible bundles
+        """
 
         candidate = None
 
@@ -510,119 +1032,69 @@ class AgentArchiverDecomposer(object):
             exist = self.included_bundles.get(bundle["name"])
             if exist:
                 # if something is already providing this file, stop searching
-                raise BundleAlreadyIncludedException(bundle)
+                return INCLUDED, bundle
             else:
                 compat = self.compatible_bundles.get(bundle["name"])
 
                 if compat and bundle["version"] == compat["version"]:
 
                     if candidate:
-                        raise AmbiguousBundleMappingException("Have multiple compatible bundles which could provide that file or property")
+                        return AMBIGUOUS, None
                     else:
                         candidate = bundle
 
         if not candidate:
-            raise NoAvailableBundleMappingException()
+            return NO_MAPPING, None
 
-        return candidate
+        return CANDIDATE, candidate
 
     def create_overrides(self):
 
-        master = self.new_package["bundleOverrides"]
-
         print("\nCreate overrides for properties found in the agent archive\n")
 
-        override_count = 0
+        wanted = {}
 
-        # Need to check what the value in the profile and the bundle are.
-        # If they are != then we need to create an override
         for property_name, value in self.archive_property_values.iteritems():
+            if property_name.startswith("instrument.") and property_name not in self.property_to_bundle_map:
+                print("\tWARNING: toggle %s=%s cannot be found in any bundles" % (property_name, value))
+                self.warnings += 1
+            else:
+                wanted[property_name] = value
 
-            # print("\tFrom archive: %s=%s" % (property, value))
-
-            # What is the value in the bundle?
-            bundle = self.property_to_bundle_map.get(property_name)
-
-            if not bundle:
+        # Need to check what the value in the profile and the bundle are.
+        # If they are != then we need to create an override
+        owners = dict((name, bundle["name"]) for name, bundle in self.property_to_bundle_map.iteritems())
+        bundles = dict((bundle["name"], bundle) for bundle in self.property_to_bundle_map.values())
 
-                if property_name.startswith("instrument."):
-                    print("\tWARNING: toggle %s=%s cannot be found in any bundles" % (property_name, value))
-                    self.warnings += 1
-                    continue
+        changes = self.overrides.require(wanted, [(name, self.property_index.properties(bundle))
+                                                  for name, bundle in bundles.iteritems()], owners)
 
+        for action, bundle_name, property_name, value, bundle_property in sorted(changes):
+            if action == "add":
                 print("\tProperty %s is not fulfilled by any bundle, need to create an override to create the property" % property_name)
-
-                overrides = master.setdefault("java-agent", {"preamble": None, "properties":[]})
-
-                prop_dic = {"description": None,
-                            "hidden": False,
-                            "name":  property_name,
-                            "value": value,
-                            "userKey": "+"}
-
-                overrides["properties"].append(prop_dic)
-
-                override_count += 1
             else:
-                bundle_property = bundle.profile_property_map[property_name]
-                bundle_value = bundle_property["value"] or ""
-
-                print("\tProperty %s=%s is fulfilled by bundle %s:%s as %s%s=%s" % (property_name, value, bundle["name"], bundle["version"], "#" if bundle_property["hidden"] else "", bundle_property["name"], bundle_value))
-
-                if value != bundle_value or bundle_property["hidden"]:
-                    print("\t\tValues differ - will create an override: %s=%s\n" % (property_name, value))
-
-                    overrides = master.setdefault(bundle["name"], {"preamble": None, "properties":[]})
+                print("\tProperty %s=%s is fulfilled by bundle %s:%s as %s%s=%s" % (
+                    property_name, value, bundle_name, bundles[bundle_name]["version"],
+                    "#" if bundle_property["hidden"] else "", bundle_property["name"], bundle_property["value"] or ""))
+                print("\t\tValues differ - will create an override: %s=%s\n" % (property_name, value))
 
-                    prop_dic = {"description": None,
-                                "hidden": False,
-                                "name":  property_name,
-                                "value": value,
-                                "userKey": bundle_property["key"]}
-
-                    overrides["properties"].append(prop_dic)
-
-                    override_count += 1
-
-        return override_count
+        return len(changes)
 
     def create_overrides_to_hide_extra_properties(self):
         print("\nChecking for extra properties in included bundles which need to be hidden in the Package\n")
 
-        master = self.new_package["bundleOverrides"]
-        override_count = 0
+        ignored = set(name for name, mapped_name in agent_property_map.iteritems() if not mapped_name)
 
-        for bundle in self.included_bundles.values():
+        bundles = sorted(self.included_bundles.values(), key=lambda bundle: bundle["name"])
 
-            print("Bundle %s:%s" % (bundle["name"], bundle["version"]))
+        changes = self.overrides.hide_others(self.archive_property_values,
+                                             [(bundle["name"], self.property_index.properties(bundle))
+                                              for bundle in bundles], ignored)
 
-            # TODO OPT we're fetching the profile again. the bundle in the compatible_bundles list should alraedy have it in there.
-            profile = bundle.profile()
-
-            for prop in profile["properties"] or []:
-                if not prop["hidden"]:
-                    if prop["name"] in agent_property_map and not agent_property_map.get(prop["name"]):
-                        print("\tIgnoring property: %s" % prop["name"])
-                        continue
+        for action, bundle_name, property_name, value, bundle_property in changes:
+            print("\thiding %s=%s in bundle %s" % (property_name, value, bundle_name))
 
-                    # Check if this property existing in the original agent package.
-                    # If it DIDN'T exist, then hide it.
-                    if not prop["name"] in self.archive_property_values:
-                        print("\thiding %s=%s" % (prop["name"], prop["value"]))
-
-                        overrides = master.setdefault(bundle["name"], {"preamble": None, "properties":[]})
-
-                        prop_dic = {"description": None,
-                                    "hidden": True,
-                                    "name":  prop["name"],
-                                    "value": prop["value"] or "",
-                                    "userKey": None}
-
-                        overrides["properties"].append(prop_dic)
-
-                        override_count += 1
-
-        return override_count
+        return len(changes)
 
     def add_bundles_to_package(self, bundles):
 
@@ -630,13 +1102,12 @@ class AgentArchiverDecomposer(object):
         for bundle in bundles:
             print("\t%s:%s" % (bundle["name"], bundle["version"]))
 
-        self.new_package.add_bundles([b["id"] for b in bundles])
+        self.package_edit.set_bundles([b["id"] for b in bundles])
 
 
 class App(pyacc.AccCommandLineApp):
 
     appservers = ["other", "ctg-server", "glassfish", "interstage", "jboss", "tomcat", "weblogic", "websphere"]
-    val_re = re.compile("^([#]?)(.*)=(.*)")
 
     """
     Convert an agent installation to an equivalent package, including creating overrides and optionally download it.
@@ -659,8 +1130,17 @@ class App(pyacc.AccCommandLineApp):
 
         self.parser.add_argument('-d', '--download', action='store_true', help="Download package after creating it")
 
+        self.parser.add_argument('--plan', action='store_true',
+                                 help="Only print the bundles and overrides the package would have, without creating it. "
+                                      "The required and compatible bundles are worked out locally rather than "
+                                      "by the Config Server, so the package created could differ")
+
         self.parser.add_argument('-y', '--yes', action='store_true', help="Answer Yes to any questions")
 
+        self.parser.add_argument('--batch', action='store_true',
+                                 help="Convert the agent archives concurrently (up to --workers packages at a time), "
+                                      "without asking any questions, and summarize them at the end")
+
         self.parser.add_argument('agent', metavar='AGENT', nargs='*', type=str, help='Agent Package')
 
     def main(self):
@@ -670,16 +1150,31 @@ class App(pyacc.AccCommandLineApp):
                 print("ERROR: %s does not exist" % agent_archive)
                 sys.exit(1)
 
-        filename_map = BundleIndex(self.acc, self.args).get_filename_map()
+        bundle_index = BundleIndex(self.acc, self.args)
+        filename_map, digest_map = bundle_index.get_maps()
+        bundle_versions = bundle_index.versions
+
+        property_index = pyacc.BundlePropertyIndex(self.acc)
+
+        if self.args.batch:
+            self.batch(filename_map, digest_map, bundle_versions, property_index)
+            return
 
         for agent_archive in self.args.agent:
 
-            aad = AgentArchiverDecomposer(self.acc, self.args, agent_archive, filename_map)
+            aad = AgentArchiverDecomposer(self.acc, self.args, agent_archive, filename_map, digest_map, bundle_versions,
+                                          property_index)
 
             aad.create_package_from_archive()
 
+            if self.args.plan:
+                print("\nPlanned a package with %d bundles and %d overrides, with %d warnings. "
+                      "Nothing was created on the Config Server." % (
+                          len(aad.planned_bundles), aad.override_count, aad.warnings))
+                continue
+
             # Gather variables in one dictionary for ease of generating the messages below
-            msg_details = {"tar_name": aad.bundle_missing and aad.bundle_missing.tar_name or "None",
+            msg_details = {"tar_name": aad.unknown_tar_name or "None",
                        "package_id": aad.new_package["id"],
                        "acc_server": self.acc.server,
                         "warnings": aad.warnings}
@@ -693,7 +1188,7 @@ Package id %(package_id)s created with %(warnings)d warnings.
             if self.args.download:
                 aad.new_package.download(".", self.args.format)
 
-            if aad.bundle_missing:
+            if aad.unknown_tar_name:
                 print("""
 Note, a new bundle has been created *locally* for unknown content:
 
@@ -721,5 +1216,117 @@ Alternatively you can view/modify/download the package within ACC here:
 
 ''' % msg_details)
 
+    def batch(self, filename_map, digest_map, bundle_versions, property_index):
+
+        """
+        Convert all the agent archives. The archives are read in a process pool while
+        the packages are created on the server in a thread pool.
+        """
+
+        agent_archives = self.args.agent
+
+        analyze_pool = multiprocessing.Pool(min(len(agent_archives), multiprocessing.cpu_count()) or 1,
+                                            init_analyze_worker, (filename_map.keys(), digest_map.keys()))
+        try:
+            analyses = [analyze_pool.apply_async(analyze_agent_archive, (agent_archive, self.args.yes))
+                        for agent_archive in agent_archives]
+
+            output = sys.stdout = ThreadOutput(sys.stdout)
+            try:
+                pool = ThreadPool(self.acc.workers)
+                try:
+                    results = pool.map(lambda item: self.convert_archive(output, filename_map, digest_map, bundle_versions,
+                                                                         property_index, *item),
+                                       zip(agent_archives, analyses))
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    # Make sure all the output is written before we print the report
+                    pool.join()
+            finally:
+                sys.stdout = output.stream
+
+            analyze_pool.close()
+        except:
+            # Don't leave worker processes analyzing archives nobody will convert
+            analyze_pool.terminate()
+            raise
+        finally:
+            analyze_pool.join()
+
+        self.print_batch_report(results)
+
+    def convert_archive(self, output, filename_map, digest_map, bundle_versions, property_index, agent_archive, analysis):
+
+        """
+        Create the package for one agent archive, returning the AgentArchiverDecomposer
+        and the error which stopped it, if any
+        """
+
+        output.capture()
+
+        def get_analysis():
+            result, text = analysis.get()
+            print(text, end="")
+            return result
+
+        aad = AgentArchiverDecomposer(self.acc, self.args, agent_archive, filename_map, digest_map, bundle_versions,
+                                      property_index)
+        error = None
+
+        try:
+            aad.create_package_from_archive(get_analysis)
+
+            if self.args.download and aad.new_package:
+                aad.new_package.download(".", self.args.format)
+        except Exception as e:
+            traceback.print_exc(file=sys.stdout)
+            error = str(e) or e.__class__.__name__
+        finally:
+            output.release()
+
+        return aad, error
+
+    def print_batch_report(self, results):
+
+        failed = len([error for aad, error in results if error])
+
+        print("""
+##############################################################################
+
+%s packages for %d of %d agent archives:
+""" % ("Planned" if self.args.plan else "Created", len(results) - failed, len(results)))
+
+        print("%-40s %10s %8s %10s %9s  %s" % ("Archive", "Package", "Bundles", "Overrides", "Warnings", "Unknown content/Error"))
+
+        for aad, error in results:
+            print("%-40s %10s %8s %10s %9d  %s" % (
+                os.path.basename(aad.agent_archive),
+                aad.new_package["id"] if aad.new_package else "-",
+                len(aad.included_bundles) if not error else "-",
+                aad.override_count if not error else "-",
+                aad.warnings,
+                "ERROR: %s" % error if error else aad.unknown_tar_name or ""))
+
+        if [aad for aad, error in results if aad.unknown_tar_name]:
+            print("""
+Note, new bundles have been created *locally* for unknown content. Please review
+them, and if you would like to include one in its package, upload the bundle and
+add it to the package, like this:
+
+  bundles.py upload 'BUNDLE_FILE' # <-- this will print the new bundle ID
+  packages.py modify --add NEW_BUNDLE_ID_FROM_BUNDLE_UPLOAD PACKAGE_ID
+""")
+
+        if not self.args.plan:
+            print("""
+You can view/modify/download the packages within ACC here:
+
+  %s/#/packages
+""" % self.acc.server)
+
+
 if __name__ == "__main__":
     App().run()
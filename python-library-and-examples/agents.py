@@ -49,6 +49,9 @@ class App(pyacc.AccCommandLineApp):
 
     def main(self):
 
+        # The columns we print for the agents
+        cols = ("id", "agentName", "osName", "appServerName", "appServerVersion", "status", "metricCount", "version")
+
         if self.args.agent_ids:
             # Create a list of Agent objects initialized with the agent id.
             # The data will be fetched (and cached) from the Config Server when the object
@@ -76,11 +79,11 @@ class App(pyacc.AccCommandLineApp):
                 # agents, unless a page has explicitly been specified
                 request_params["page"] = 0
 
-            # This will fetch a filtered list of agents a page a time when we iterate over it
-            agents = self.acc.agents(**request_params)
+            # This will fetch a filtered list of agents a page a time when we iterate over it.
+            # We only print a few fields so use the compact records rather than full Agent objects.
+            agents = self.acc.agents(fields=cols, **request_params).records()
 
         # Print the status of the agents
-        cols = ("id", "agentName", "osName", "appServerName", "appServerVersion", "status", "metricCount", "version")
         print("\t".join(cols))
 
         for agent in agents:
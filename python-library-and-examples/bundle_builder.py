@@ -36,17 +36,22 @@ placed in unusual locations
 from __future__ import print_function
 
 import argparse
+import collections
 import os
+import re
 import StringIO
+import struct
 import time
 import tempfile
 import shutil
 import json
 import tarfile
 import getpass
+import hashlib
 import socket
+import zlib
 
-from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
 
 bundle_file_map = {
@@ -64,25 +69,49 @@ bundle_ext_map = {
     ".profile": "wily/core/config"
 }
 
+# Empty files all have the same content, but there is nothing to be gained from treating them as duplicates
+EMPTY_DIGEST = hashlib.sha1().hexdigest()
+
+# Where SegmentCache keeps compressed blocks, shared with the other ACC scripts' cache
+SEGMENT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".acc", "cache", "segments")
+
+# How big the SegmentCache may get (in MB) before the least recently used blocks are removed
+SEGMENT_CACHE_SIZE = 256
+
+# Blocks smaller than this are quicker to compress again than to keep in the SegmentCache
+SEGMENT_MIN_SIZE = 16 * 1024
+
+# The components of a version, as split by distutils' LooseVersion
+VERSION_COMPONENT_RE = re.compile(r"(\d+|[a-z]+|\.)")
+
 
 class BundleFileMapper(object):
 
+    """
+    Work out where files go in a bundle. Paths are split a directory at a time and the
+    split of each directory is remembered, so use one mapper for all the files of a bundle.
+    """
+
+    def __init__(self):
+        # directory -> list of its path components
+        self.split_dirs = {}
+
     def split_path(self, the_path):
         """Split a path into a list"""
 
-        path_split = []
+        head, file = os.path.split(the_path)
 
-        while True:
-            the_path, file = os.path.split(the_path)
-            # print("path_abs", path_abs)
-            # print("file", file)
+        if not head or head == "/" or head == the_path:
+            return [file]
 
-            path_split.insert(0, file)
+        return self._split_dir(head) + [file]
 
-            if not the_path or the_path == "/":
-                break
+    def _split_dir(self, directory):
+        path_split = self.split_dirs.get(directory)
+
+        if path_split is None:
+            path_split = self.split_dirs[directory] = self.split_path(directory)
 
-        # print("path_split", path_split)
         return path_split
 
     def file_to_bundle(self, path):
@@ -134,20 +163,12 @@ class BundleFileMapper(object):
 class BundleVersion(object):
 
     def __init__(self, version_string):
-        lv = LooseVersion(version_string)
+        components = [c for c in VERSION_COMPONENT_RE.split(version_string) if c and c != "."]
 
-        if len(lv.version) > 4:
+        if len(components) > 4:
             raise Exception("Unsupported version format")
 
-        self.bundle_version = [0, 0, 0, 0]
-
-        try:
-            self.bundle_version[0] = self.munge(lv.version[0])
-            self.bundle_version[1] = self.munge(lv.version[1])
-            self.bundle_version[2] = self.munge(lv.version[2])
-            self.bundle_version[3] = self.munge(lv.version[3])
-        except IndexError:
-            pass
+        self.bundle_version = [self.munge(c) for c in components] + [0] * (4 - len(components))
 
     def munge(self, ver_comp):
         """Make sure all version components are integers, otherwise set to 0"""
@@ -195,7 +216,7 @@ class BundleSpec(object):
         return self.j["version"]
 
     def meta_json(self):
-        return json.dumps(self.j, indent=2, sort_keys=2)
+        return utf8(json.dumps(self.j, indent=2, sort_keys=2))
 
     def __getitem__(self, key):
         """
@@ -209,35 +230,243 @@ class BundleSpec(object):
             raise
 
 
+def utf8(text):
+    """Encode unicode text as UTF-8, leaving byte strings as they are"""
+    return text.encode("UTF-8") if isinstance(text, unicode) else text
+
+
+def compress_block(data, compresslevel, flush_mode):
+    """Compress data as raw deflate, ending on a byte boundary unless flush_mode is Z_FINISH"""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(flush_mode)
+
+
+class SegmentCache(object):
+
+    """
+    Compressed blocks of bundles (see ParallelGzipFile), stored under the sha1 digest of the
+    uncompressed block, so content which has been compressed before is not compressed again.
+    Using a block updates its modification time, and prune() removes the least recently used
+    blocks once the cache is bigger than max_size MB.
+    """
+
+    def __init__(self, directory=None, max_size=SEGMENT_CACHE_SIZE):
+        self.directory = directory or SEGMENT_CACHE_DIR
+        self.max_size = max_size * 1024 * 1024
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as fin:
+                data = fin.read()
+            os.utime(path, None)
+            return data
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, data):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as fout:
+            fout.write(data)
+        os.rename(temp_path, path)
+
+    def prune(self):
+        """Remove the least recently used blocks until the cache is no bigger than max_size"""
+        blocks = []
+        total = 0
+
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                blocks.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        blocks.sort()
+
+        for mtime, size, path in blocks:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class ParallelGzipFile(object):
+
+    """
+    A write only gzip file which compresses on several threads, like pigz.
+
+    The data is cut into blocks which are compressed independently (zlib releases the GIL while
+    compressing) and each one is flushed to a byte boundary, so the compressed blocks can simply
+    be written out one after the other as a single deflate stream, the last one finishing it.
+    The CRC is calculated as the data is written. The output only depends on the data and
+    mtime, not on the number of threads.
+
+    Because the blocks are independent, a block which has been compressed before can be taken
+    from a SegmentCache. Calling align() between tar entries makes each entry start a new block,
+    so the blocks of an unchanged entry stay the same when other entries change.
+    """
+
+    block_size = 128 * 1024
+
+    def __init__(self, fileobj, jobs, compresslevel=9, mtime=None, cache=None):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.cache = cache
+
+        self.pool = ThreadPool(jobs) if jobs > 1 else None
+        self.max_pending = 2 * jobs
+
+        # (cache key, compressed block or pending result) in the order they are to be written
+        self.pending = collections.deque()
+
+        self.buffer = ""
+        self.crc = zlib.crc32("")
+        self.size = 0
+
+        if mtime is None:
+            mtime = time.time()
+
+        # No file name, XFL for maximum compression, unknown OS (as the gzip module does)
+        self.fileobj.write("\037\213\010\000" + struct.pack("<L", long(mtime)) + "\002\377")
+
+    def tell(self):
+        """The position in the uncompressed data, which is what tarfile needs to know"""
+        return self.size
+
+    def write(self, data):
+        if not isinstance(data, str):
+            raise TypeError("ParallelGzipFile only writes bytes, not %s" % type(data).__name__)
+
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        self.buffer += data
+
+        while len(self.buffer) >= self.block_size:
+            block, self.buffer = self.buffer[:self.block_size], self.buffer[self.block_size:]
+            self._compress(block, zlib.Z_FULL_FLUSH)
+
+    def align(self):
+        """End the current block, so that what is written next starts a new one"""
+        if self.buffer:
+            self._compress(self.buffer, zlib.Z_FULL_FLUSH)
+            self.buffer = ""
+
+    def _compress(self, block, flush_mode):
+        key = None
+        compressed = None
+
+        if self.cache and flush_mode == zlib.Z_FULL_FLUSH and len(block) >= SEGMENT_MIN_SIZE:
+            key = "%s-%d" % (hashlib.sha1(block).hexdigest(), self.compresslevel)
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                key = None  # nothing to store
+
+        if compressed is None:
+            if self.pool:
+                compressed = self.pool.apply_async(compress_block, (block, self.compresslevel, flush_mode))
+            else:
+                compressed = compress_block(block, self.compresslevel, flush_mode)
+
+        self.pending.append((key, compressed))
+
+        # Don't let the compressed data pile up in memory if writing is slower
+        while len(self.pending) > self.max_pending:
+            self._write_pending()
+
+    def _write_pending(self):
+        key, compressed = self.pending.popleft()
+
+        if not isinstance(compressed, str):
+            compressed = compressed.get()
+
+        if key:
+            self.cache.put(key, compressed)
+
+        self.fileobj.write(compressed)
+
+    def close(self):
+        self._compress(self.buffer, zlib.Z_FINISH)
+        self.buffer = ""
+
+        while self.pending:
+            self._write_pending()
+
+        self.fileobj.write(struct.pack("<LL", self.crc & 0xffffffffL, self.size & 0xffffffffL))
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+
 class BundleBuilder(object):
-    def __init__(self, name, force_overwrite_existing):
+
+    """
+    Build a bundle archive. With jobs > 1 the archive is compressed on that many threads
+    (see ParallelGzipFile). A reproducible bundle has its entries sorted by name, with no
+    timestamps or ownership, so the same content always gives exactly the same file.
+    Given a SegmentCache, each entry is compressed separately and entries which have been
+    compressed before are taken from the cache.
+    """
+
+    def __init__(self, name, force_overwrite_existing, jobs=1, reproducible=False, cache=None):
         self.update_bundle_version = True
         self.force_overwrite_existing = force_overwrite_existing
+        self.reproducible = reproducible
+        self.cache = cache
 
         self.spec = BundleSpec(name)
 
         self.tar_name = None
         self.tar_name_temp = tempfile.mktemp()
 
-        self.tar = tarfile.open(self.tar_name_temp, "w:gz")
+        self.gzip_file = self.out = None
+
+        if jobs > 1 or reproducible or cache:
+            self.out = open(self.tar_name_temp, "wb")
+            self.gzip_file = ParallelGzipFile(self.out, jobs, mtime=0 if reproducible else None, cache=cache)
+            self.tar = tarfile.open(fileobj=self.gzip_file, mode="w")
+        else:
+            self.tar = tarfile.open(self.tar_name_temp, "w:gz")
+
+        # Reproducible bundles are written when closed, in order. Until then the entries and
+        # their content (in the staging file) are kept here.
+        self.staged = []
+        self.staging = tempfile.TemporaryFile() if reproducible else None
+
         self.added_spec = self.added_desc = self.added_toggles = False
         self.added = {}
 
+        self.mapper = BundleFileMapper()
+
     def description_template(self):
-        return """This is the template description file for %(name)s
-        """ % self.spec.j
+        return utf8("""This is the template description file for %(name)s
+        """ % self.spec.j)
 
-    def _add(self, origin, tarinfo, fileobj=None):
+    def _add(self, origin, tarinfo, fileobj=None, local_entity_name=None):
 
         archive_filename = tarinfo.name
 
         if self.added.get(archive_filename):
             raise Exception("Already added: " + archive_filename)
 
-        if fileobj:
-            local_entity_name = fileobj.name
-        else:
-            local_entity_name = tarinfo.name
+        if not local_entity_name:
+            local_entity_name = fileobj.name if fileobj else tarinfo.name
 
         if local_entity_name == archive_filename:
             print("[%s] %s" % (origin, archive_filename))
@@ -291,10 +520,40 @@ class BundleBuilder(object):
                 elif os.path.basename(archive_filename) == "description.md":
                     self.added_desc = True
 
-        self.tar.addfile(tarinfo, fileobj)
+        if self.reproducible:
+            self._stage(tarinfo, fileobj)
+        else:
+            self._addfile(tarinfo, fileobj)
 
         self.added[archive_filename] = True
 
+    def _addfile(self, tarinfo, fileobj):
+        if self.cache:
+            self.gzip_file.align()
+
+        self.tar.addfile(tarinfo, fileobj)
+
+    def _stage(self, tarinfo, fileobj):
+        tarinfo.mtime = 0
+        tarinfo.uname = tarinfo.gname = ""
+        tarinfo.uid = tarinfo.gid = 0
+
+        self.staging.seek(0, os.SEEK_END)
+        offset = self.staging.tell()
+
+        if fileobj and tarinfo.isreg():
+            shutil.copyfileobj(fileobj, self.staging)
+
+        self.staged.append((tarinfo, offset))
+
+    def _write_staged(self):
+        # Hard links have to come after the file they link to
+        for tarinfo, offset in sorted(self.staged, key=lambda entry: (entry[0].islnk(), entry[0].name)):
+            self.staging.seek(offset)
+            self._addfile(tarinfo, self.staging if tarinfo.isreg() else None)
+
+        self.staging.close()
+
     def add_file(self, local_filename, archive_filename=None):
         """
         archive_filename is the final name in the tar
@@ -307,14 +566,33 @@ class BundleBuilder(object):
             return
 
         if not archive_filename:
-            archive_filename = BundleFileMapper().get_archive_target_dest(os.path.abspath(local_filename))
+            archive_filename = self.mapper.get_archive_target_dest(os.path.abspath(local_filename))
+
+        tarinfo = self.tar.gettarinfo(local_filename, archive_filename)
+        tarinfo.uname = tarinfo.gname = ""
+        tarinfo.uid = tarinfo.gid = 0
+
+        if tarinfo.isdir():
+            self._add("file", tarinfo, None)
+        else:
+            with open(local_filename, "rb") as fileobj:
+                self._add("file", tarinfo, fileobj)
 
+        return tarinfo
+
+    def add_hardlink(self, local_filename, archive_filename, target_archive_filename):
+        """
+        Add a file as a hard link to a file already in the bundle with exactly the same content,
+        so the content is only stored once
+        """
         tarinfo = self.tar.gettarinfo(local_filename, archive_filename)
+        tarinfo.type = tarfile.LNKTYPE
+        tarinfo.linkname = target_archive_filename
+        tarinfo.size = 0
         tarinfo.uname = tarinfo.gname = ""
         tarinfo.uid = tarinfo.gid = 0
 
-        with open(local_filename, "rb") as fileobj:
-            self._add("file", tarinfo, fileobj)
+        self._add("link", tarinfo, None, "%s (same as %s)" % (local_filename, target_archive_filename))
 
         return tarinfo
 
@@ -322,6 +600,9 @@ class BundleBuilder(object):
 
         # print("[string] -> %s" % archive_filename)
 
+        # The spec is read from json so the content may be unicode, the size is that of the bytes
+        content = utf8(content)
+
         tarinfo = tarfile.TarInfo(archive_filename)
         tarinfo.size = len(content)
         tarinfo.mtime = time.time()
@@ -331,19 +612,22 @@ class BundleBuilder(object):
 
         self._add("string", tarinfo, fileobj)
 
-    def add_tarinfo_entry(self, tar, tarinfo):
-        archive_filename = BundleFileMapper().get_archive_target_dest(tarinfo.name)
+    def add_tarinfo_entry(self, tar, tarinfo, fileobj=None):
+        """
+        Add an entry of another tar. fileobj is the content of the entry if it has
+        already been read, e.g. when the tar is being streamed.
+        """
+        archive_filename = self.mapper.get_archive_target_dest(tarinfo.name)
 
-        fileobj = None
-        if not tarinfo.isdir():
+        if not fileobj and tarinfo.isfile():
             fileobj = tar.extractfile(tarinfo)
 
         # We do not particularly want to inherit the user/group settings in the bundle
         tarinfo.uname = tarinfo.gname = ""
         tarinfo.uid = tarinfo.gid = 0
-        tarinfo.name = archive_filename
+        local_entity_name, tarinfo.name = tarinfo.name, archive_filename
 
-        self._add("tar", tarinfo, fileobj)
+        self._add("tar", tarinfo, fileobj, local_entity_name)
 
     def close(self):
 
@@ -362,8 +646,15 @@ class BundleBuilder(object):
                 print("No description.md file added, adding template description.md file")
                 self.add_string(self.description_template(), "metadata/description.md")
 
+            if self.reproducible:
+                self._write_staged()
+
             self.tar.close()
 
+            if self.gzip_file:
+                self.gzip_file.close()
+                self.out.close()
+
             if not self.tar_name:
                 self.tar_name = "%s-%s.tar.gz" % (self.spec["name"], self.spec["version"])
 
@@ -374,6 +665,97 @@ class BundleBuilder(object):
             print("%s -> %s" % (self.tar_name_temp, self.tar_name))
 
 
+def list_directory(directory):
+    """Return the names of the (directories, files) in a directory, or None if it cannot be read"""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return None
+
+    dirs, files = [], []
+    for name in names:
+        if os.path.isdir(os.path.join(directory, name)):
+            dirs.append(name)
+        else:
+            files.append(name)
+
+    return dirs, files
+
+
+def file_digest(filename, chunk_size=1048576):
+    """Return the sha1 hex digest of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(filename, "rb") as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), ""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class BundleManifest(object):
+
+    """
+    A record of the inputs of a bundle build (path, size, mtime and digest of each) and the
+    bundle built from them, saved as json next to the bundle, so that a build whose inputs
+    have not changed can be skipped. Files whose size and mtime are the same as last time are
+    taken to have the same digest, so they are not even read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous = self.load()
+
+        # path -> what we knew about the input last time
+        self.previous_inputs = dict((entry["path"], entry) for entry in (self.previous or {}).get("inputs", []))
+
+    def load(self):
+        try:
+            with open(self.path, "rt") as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+    def known_digest(self, local_filename):
+        """The digest of a file from the last build, if its size and mtime have not changed since"""
+        old = self.previous_inputs.get(local_filename)
+        st = os.stat(local_filename)
+
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            return old["digest"]
+
+        return None
+
+    def describe(self, inputs, options, digests):
+        """
+        Describe the inputs, a list of (local filename, archive filename), and options of a build.
+        digests maps local filename to the digest of its content.
+        """
+        described = []
+        for local_filename, archive_filename in inputs:
+            st = os.stat(local_filename)
+            described.append({"path": local_filename, "archive": archive_filename,
+                              "size": st.st_size, "mtime": st.st_mtime, "digest": digests.get(local_filename)})
+
+        return {"options": options, "inputs": described}
+
+    def up_to_date(self, current):
+        """Is the bundle built last time still there, and built from the same content?"""
+        if not self.previous or not os.path.exists(self.previous.get("output") or ""):
+            return False
+
+        def content(manifest):
+            return [(entry["path"], entry["archive"], entry["size"], entry["digest"]) for entry in manifest["inputs"]]
+
+        return self.previous["options"] == current["options"] and content(self.previous) == content(current)
+
+    def save(self, current, tar_name):
+        current["output"] = tar_name
+
+        temp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(temp_path, "wt") as fout:
+            json.dump(current, fout, indent=2, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+
 class App(object):
     """
     Bundle file manipulator. Create bundles from the given files.
@@ -409,6 +791,26 @@ class App(object):
 
         self.parser.add_argument('-n', '--name', action='store', help="Bundle name")
 
+        self.parser.add_argument('-j', '--jobs', action='store', type=int, default=1,
+                                 help="compress the bundle using this many threads")
+
+        self.parser.add_argument('--dedupe', action='store_true',
+                                 help="store files with identical content once, the others as hard links to it")
+
+        self.parser.add_argument('--reproducible', action='store_true',
+                                 help="sort the entries and leave out timestamps and ownership, "
+                                      "so the same files always give an identical bundle")
+
+        self.parser.add_argument('-i', '--incremental', action='store_true',
+                                 help="only build the bundle if the files have changed since the last build, "
+                                      "and reuse the compressed content of files which have not. The compressed "
+                                      "blocks are kept in ~/.acc/cache/segments, and the bundle is always written by "
+                                      "the parallel gzip writer, even with -j 1")
+        self.parser.add_argument('--cache-size', action='store', type=int, default=SEGMENT_CACHE_SIZE,
+                                 help="the most MB of compressed blocks --incremental keeps (default %(default)s)")
+        self.parser.add_argument('--manifest', action='store',
+                                 help="where --incremental keeps track of the last build (default NAME.manifest.json)")
+
         # To force files to particular directories in the bundle, you can specify them uses these switches
         # Add more directories here if needed.
         self.parser.add_argument('-t', '--tools', action='append', default=[], help="put file under wily/core/tools")
@@ -427,46 +829,175 @@ class App(object):
                 if not os.path.exists(file):
                     raise Exception("File does not exist: " + file)
 
-    def main(self):
+    def scan_tree(self, pool, top):
+        """
+        Return the files under top, and any empty directories, in the order os.walk would find
+        them. The directories of each level of the tree are listed concurrently.
+        """
+        listings = {}
+        level = [top]
 
-        bundle = BundleBuilder(self.args.name, self.args.force)
+        while level:
+            next_level = []
+            for directory, listing in zip(level, pool.map(list_directory, level)):
+                if listing is not None:
+                    listings[directory] = listing
 
-        bundle.update_bundle_version = not self.args.no_version_update
+                    # Like os.walk, don't follow links to directories
+                    next_level.extend(path for path in (os.path.join(directory, name) for name in listing[0])
+                                      if not os.path.islink(path))
+            level = next_level
 
-        self.check_files_exist(self.args.bundle_files, self.args.tools, self.args.ext, self.args.config)
+        found = []
+
+        def visit(directory):
+            if directory not in listings:
+                return
+
+            dir_names, files = listings[directory]
+
+            if not files and not dir_names:
+                # Add empty directory
+                found.append(directory)
+            else:
+                found.extend(os.path.join(directory, file) for file in files)
+                for dir_name in dir_names:
+                    visit(os.path.join(directory, dir_name))
+
+        visit(top)
+        return found
+
+    def collect_inputs(self, pool):
+        """
+        Return (kind, local filename, archive filename) for each of the files to go in the bundle,
+        kind being "tar" for a tar file whose entries are to be added.
+        """
+        inputs = []
 
         for bundle_file in self.args.bundle_files:
 
             if bundle_file.endswith(".tar") or bundle_file.endswith("tar.gz"):
-                with tarfile.open(bundle_file) as btf:
-                    for ti in btf.getmembers():
-                        bundle.add_tarinfo_entry(btf, ti)
+                inputs.append(("tar", bundle_file, None))
             else:
                 if os.path.isdir(bundle_file):
                     # walk the specified directory
-                    for root, dir_names, files in os.walk(bundle_file):
-                        if not files and not dir_names:
-                            # Add empty directory
-                            bundle.add_file(os.path.join(root))
-                        else:
-                            for file in files:
-                                bundle.add_file(os.path.join(root, file))
+                    for local_filename in self.scan_tree(pool, bundle_file):
+                        inputs.append(("file", local_filename, None))
                 else:
-                    bundle.add_file(bundle_file)
+                    inputs.append(("file", bundle_file, None))
 
         for tool in self.args.tools:
-            bundle.add_file(tool, os.path.join("wily/core/tools", os.path.basename(tool)))
+            inputs.append(("file", tool, os.path.join("wily/core/tools", os.path.basename(tool))))
 
         for ext in self.args.ext:
-            bundle.add_file(ext, os.path.join("wily/core/ext", os.path.basename(ext)))
+            inputs.append(("file", ext, os.path.join("wily/core/ext", os.path.basename(ext))))
 
         for config in self.args.config:
-            bundle.add_file(config, os.path.join("wily/core/config", os.path.basename(config)))
+            inputs.append(("file", config, os.path.join("wily/core/config", os.path.basename(config))))
 
         # (Add more wily subdirectories as required)
 
+        mapper = BundleFileMapper()
+
+        return [(kind, local_filename, archive_filename or
+                 (kind == "file" and mapper.get_archive_target_dest(os.path.abspath(local_filename)) or None))
+                for kind, local_filename, archive_filename in inputs]
+
+    def digest_inputs(self, pool, inputs, manifest):
+        """Return a map of local filename to the digest of its content, hashing the files concurrently"""
+
+        def digest(item):
+            kind, local_filename, archive_filename = item
+
+            # The content of tar files only matters to the manifest
+            if os.path.isdir(local_filename) or (kind == "tar" and not manifest):
+                return None
+
+            return manifest and manifest.known_digest(local_filename) or file_digest(local_filename)
+
+        return dict(zip([local_filename for kind, local_filename, archive_filename in inputs],
+                        pool.map(digest, inputs)))
+
+    def find_duplicates(self, inputs, digests):
+        """Return a map of archive filename to the archive filename of the first file with the same content"""
+
+        first = {}
+        duplicates = {}
+
+        for kind, local_filename, archive_filename in inputs:
+            digest = digests.get(local_filename)
+
+            # Bundle metadata and toggles files get special treatment, so leave them be
+            if kind != "file" or not digest or digest == EMPTY_DIGEST or archive_filename.startswith("metadata/") \
+                    or "toggles" in os.path.basename(archive_filename):
+                continue
+
+            if digest in first:
+                print("WARNING: %s has the same content as %s" % (archive_filename, first[digest]))
+                duplicates[archive_filename] = first[digest]
+            else:
+                first[digest] = archive_filename
+
+        if duplicates and not self.args.dedupe:
+            print("%d files are duplicates, use --dedupe to only store their content once" % len(duplicates))
+
+        return duplicates
+
+    def main(self):
+
+        self.check_files_exist(self.args.bundle_files, self.args.tools, self.args.ext, self.args.config)
+
+        manifest = current = None
+
+        if self.args.incremental:
+            manifest = BundleManifest(self.args.manifest or "%s.manifest.json" % (self.args.name or "bundle"))
+
+        # Scanning and hashing are mostly waiting on the disk, so use a few threads even with -j 1
+        pool = ThreadPool(max(self.args.jobs, 4))
+        try:
+            inputs = self.collect_inputs(pool)
+            digests = self.digest_inputs(pool, inputs, manifest)
+        finally:
+            pool.close()
+
+        if manifest:
+            current = manifest.describe([(local_filename, archive_filename) for kind, local_filename, archive_filename in inputs],
+                                        {"name": self.args.name,
+                                         "version_update": not self.args.no_version_update,
+                                         "reproducible": self.args.reproducible,
+                                         "dedupe": self.args.dedupe},
+                                        digests)
+
+            if manifest.up_to_date(current):
+                print("No files have changed since %s was built" % manifest.previous["output"])
+                return
+
+        duplicates = self.find_duplicates(inputs, digests)
+
+        cache = SegmentCache(max_size=self.args.cache_size) if self.args.incremental else None
+
+        bundle = BundleBuilder(self.args.name, self.args.force, self.args.jobs, self.args.reproducible, cache=cache)
+
+        bundle.update_bundle_version = not self.args.no_version_update
+
+        for kind, local_filename, archive_filename in inputs:
+            if kind == "tar":
+                with tarfile.open(local_filename) as btf:
+                    for ti in btf.getmembers():
+                        bundle.add_tarinfo_entry(btf, ti)
+            elif self.args.dedupe and archive_filename in duplicates:
+                bundle.add_hardlink(local_filename, archive_filename, duplicates[archive_filename])
+            else:
+                bundle.add_file(local_filename, archive_filename)
+
         bundle.close()
 
+        if cache:
+            cache.prune()
+
+        if manifest:
+            manifest.save(current, bundle.tar_name)
+
 
 if __name__ == "__main__":
     App().main()
@@ -6,6 +6,12 @@ import pyacc
 
 from pyacc import safe
 
+
+def text(value):
+    """Format a value decoded from json for printing, with any unicode encoded as UTF-8"""
+    value = pyacc.utf8(value)
+    return value if isinstance(value, str) else safe(value)
+
 # TODO this should also be able to list the bundle profile
 
 class App(pyacc.AccCommandLineApp):
@@ -41,6 +47,10 @@ class App(pyacc.AccCommandLineApp):
         delete_parser.add_argument('bundle_ids', metavar='BUNDLE_ID', nargs='+', type=str,
                                    help='bundle ids')
 
+        diff_parser = subparsers.add_parser("diff", help="compare the metadata, properties and files of two bundles")
+        diff_parser.add_argument('bundle_ids', metavar='BUNDLE_ID', nargs=2, type=str,
+                                 help='the two bundle ids to compare')
+
     def download(self):
         for bundle in self._get_bundles():
             filename = bundle.download(".")
@@ -78,6 +88,60 @@ class App(pyacc.AccCommandLineApp):
             b = self.acc.bundle(bundle_id)
             b.delete()
 
+    def diff(self):
+
+        """
+        Compare two bundles. The files are compared by the digests in the local bundle
+        store, so each bundle archive is only downloaded and read once, ever.
+        """
+
+        a, b = self.acc.bundles_many(self.args.bundle_ids)
+
+        print("Comparing %s:%s (%s) with %s:%s (%s)" % (a["name"], a["version"], a.item_id,
+                                                       b["name"], b["version"], b.item_id))
+
+        print("\nMetadata:")
+        differences = 0
+        for key in sorted(set(a.get_json()) | set(b.get_json())):
+            # The links are made from the bundle id so always differ
+            if key not in ("id", "_links") and a.get_json().get(key) != b.get_json().get(key):
+                print("\t%s: %s -> %s" % (key, text(a.get_json().get(key)), text(b.get_json().get(key))))
+                differences += 1
+        if not differences:
+            print("\tsame")
+
+        property_index = pyacc.BundlePropertyIndex(self.acc)
+        property_index.refresh([a, b], verbose=False)
+
+        def property_values(bundle):
+            return dict((text(prop["name"]), "%s%s" % ("#" if prop["hidden"] else "", text(prop["value"])))
+                        for prop in property_index.properties(bundle))
+
+        print("\nProperties:")
+        self._print_diff(property_values(a), property_values(b))
+
+        store = pyacc.BundleStore(self.acc)
+        store.sync([a, b])
+
+        print("\nFiles:")
+        self._print_diff(dict(store.file_digests(a)), dict(store.file_digests(b)), show_values=False)
+
+    def _print_diff(self, old, new, show_values=True):
+        """Print what was added (+), removed (-) and changed (~) between two maps of name to value"""
+        unchanged = 0
+
+        for name in sorted(set(old) | set(new)):
+            if name not in old:
+                print("\t+ %s%s" % (name, "=" + new[name] if show_values else ""))
+            elif name not in new:
+                print("\t- %s%s" % (name, "=" + old[name] if show_values else ""))
+            elif old[name] != new[name]:
+                print("\t~ %s%s" % (name, "=%s -> %s" % (old[name], new[name]) if show_values else ""))
+            else:
+                unchanged += 1
+
+        print("\t%d the same" % unchanged)
+
     def _get_bundles(self):
         if self.args.bundle_ids:
             # Create a list of Bundle objects initialized with the bundle id.
@@ -99,6 +163,7 @@ class App(pyacc.AccCommandLineApp):
             # "create": self.create,
             "upload": self.upload,
             "download": self.download,
+            "diff": self.diff,
         }[self.args.command]
         cmd()
 
@@ -111,18 +111,18 @@ class App(pyacc.AccCommandLineApp):
         so let's do it here.
 
         First request the status of all tasks, and create a dictionary of controllers
-        which contains the list of tasks.
+        which contains the list of tasks. The task to controller mapping is cached
+        so only new tasks cost an extra request.
         """
 
         dic = {}
 
-        for task in self.acc.upgrade_status():
-            upgrade_id = task["id"]
+        tasks = list(self.acc.upgrade_status())
 
-            controller = self.acc.controller_from_upgrade_id(upgrade_id)
-            controller_id = controller["id"]
+        controller_ids = self.acc.controller_ids_from_upgrade_ids([task["id"] for task in tasks])
 
-            dic.setdefault(controller_id, []).append(task)
+        for task in tasks:
+            dic.setdefault(controller_ids[task["id"]], []).append(task)
 
         cols = ("controller_id", "id", "status", "creationTimestamp", "completionTimestamp", "currentVersion")
         print("\t".join(cols))
@@ -27,8 +27,8 @@ class App(pyacc.AccCommandLineApp):
             # is queried (e.g. "agent["agentName"])
             controllers = self.acc.controllers_many(self.args.controller_ids)
         else:
-            # This will fetch all agents (a page a time)
-            controllers = self.acc.controllers()
+            # This will fetch all controllers (a page a time), only keeping the fields we print
+            controllers = self.acc.controllers(fields=("serverName", "version", "available"))
 
         for controller in controllers:
 
@@ -2,12 +2,20 @@
 
 from __future__ import print_function
 
+import os
 import sys
-import re
+import time
+import collections
+
+from multiprocessing.pool import ThreadPool
 
 import pyacc
 
 
+def megabytes(size):
+    return "%.1f MB" % (size / 1048576.0)
+
+
 class App(pyacc.AccCommandLineApp):
     """
     List packages / add new bundles to packages / create new packages / download packages.
@@ -163,9 +171,68 @@ class App(pyacc.AccCommandLineApp):
             print(new_package)
 
     def download(self):
-        # The package will be named automatically by a name suggested from the Config Server
-        for package in self._get_packages():
-            filename = package.download(".", self.args.format, em_host=self.args.em_host, overwrite=self.args.force)
+        """
+        Download the packages concurrently (see --workers). The package will be named automatically by a
+        name suggested from the Config Server. Packages that have been downloaded before come from the
+        local cache (see pyacc.ArtifactCache) and those already in the current directory are skipped
+        without asking the Config Server to build them at all.
+        """
+        packages = list(self._get_packages())
+        cache = self.acc.artifact_cache()
+
+        def download(package):
+            start = time.time()
+            try:
+                key = package.artifact_key(self.args.format, self.args.em_host)
+                filename = key and cache.filename(key)
+                filename = filename and os.path.join(".", filename)
+
+                if filename and not self.args.force and os.path.exists(filename):
+                    return package, filename, "existing", 0, 0.0
+
+                filename, from_cache = package.fetch_archive(".", self.args.format, em_host=self.args.em_host,
+                                                             overwrite=self.args.force, verbose=False)
+
+                if from_cache:
+                    return package, filename, "cached", 0, time.time() - start
+
+                return package, filename, "downloaded", os.path.getsize(filename), time.time() - start
+            except (pyacc.ACCException, EnvironmentError) as e:
+                return package, str(e), "failed", 0, time.time() - start
+
+        if not packages:
+            return
+
+        counts = collections.Counter()
+        total_size = 0
+        start = time.time()
+
+        pool = ThreadPool(min(self.acc.workers, len(packages)))
+        try:
+            for done, (package, filename, status, size, elapsed) in enumerate(
+                    pool.imap_unordered(download, packages), 1):
+                counts[status] += 1
+                total_size += size
+
+                if status == "downloaded":
+                    detail = "%s downloaded %s in %.1fs (%s/s)" % (
+                        filename, megabytes(size), elapsed, megabytes(size / max(elapsed, 0.001)))
+                elif status == "cached":
+                    detail = "%s copied from the cache" % filename
+                elif status == "existing":
+                    detail = "%s already exists" % filename
+                else:
+                    detail = "package id %s failed: %s" % (package.item_id, filename)
+
+                print("[%d/%d] %s" % (done, len(packages), detail))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - start
+        print("\nDownloaded %d packages, %s in %.1fs (%s/s), %d from the cache, %d already existed, %d failed" % (
+            counts["downloaded"], megabytes(total_size), elapsed, megabytes(total_size / max(elapsed, 0.001)),
+            counts["cached"], counts["existing"], counts["failed"]))
 
     def modify(self):
 
@@ -175,6 +242,9 @@ class App(pyacc.AccCommandLineApp):
             self.list()
             return
 
+        edits = []
+        read_only = []
+
         for package in self._get_packages():
 
             # Print the package details
@@ -200,25 +270,33 @@ class App(pyacc.AccCommandLineApp):
 
             if package["downloaded"] and not package["latest"]:
                 print("\nPackage id %s is read only because it has been downloaded and is not the latest version (id %d is the latest)" % (package.item_id, package["latestPackageID"]))
-                if self.args.add:
-                    sys.exit(1)
+                if self.args.add or self.args.remove:
+                    # Carry on so the other packages are still updated
+                    print("Not updating Package", package.item_id)
+                    read_only.append(package.item_id)
+                    continue
 
             if self.args.add or self.args.remove:
                 print("Adding bundles", self.args.add)
                 print("Removing bundles", self.args.remove)
-                before = set(included_ids)
 
-                included_ids.update(self.args.add)
-                included_ids.difference_update(self.args.remove)
+                after = included_ids.union(self.args.add).difference(self.args.remove)
 
-                if len(before ^ included_ids) == 0:
-                    print("Bundle set would be unchanged - not updating Package")
-                else:
-                    after = sorted(included_ids, key=int)
-                    print("Bundle set is", after)
+                # TODO validate/expand the input against data retrieve above.
+                edit = package.edit(sorted(included_ids, key=int))
+                edit.set_bundles(sorted(after, key=int))
+                edits.append(edit)
 
-                    # TODO validate/expand the input against data retrieve above. need to pass in the existing bundles.
-                    package.add_bundles(after);
+        # Update all the packages at once, each with a single request
+        for edit, changed in zip(edits, pyacc.apply_package_edits(edits, self.acc.workers)):
+            if changed:
+                print("Package %s bundle set is %s" % (edit.package.item_id, sorted(edit.current_bundle_ids, key=int)))
+            else:
+                print("Package %s bundle set would be unchanged - not updating Package" % edit.package.item_id)
+
+        if read_only:
+            print("Read only packages not updated:", ", ".join(str(item_id) for item_id in read_only))
+            sys.exit(1)
 
     def overrides(self):
         """Route override command to the handler"""
@@ -238,6 +316,8 @@ class App(pyacc.AccCommandLineApp):
             print("Need at least 2 packages (src, dest), trying listing with 'overrides list' to get the ids")
             sys.exit(1)
 
+        edits = []
+
         for package in packages:
             package.get_json()
             if not src:
@@ -247,7 +327,13 @@ class App(pyacc.AccCommandLineApp):
                     print("Cannot copy override onto self")
                 else:
                     print("Copying overrides from %s to %s" % (src.item_id, package.item_id))
-                    package.add_overrides(src["bundleOverrides"])
+                    edit = package.edit()
+                    edit.bundle_overrides = src["bundleOverrides"]
+                    edits.append(edit)
+
+        for edit, changed in zip(edits, pyacc.apply_package_edits(edits, self.acc.workers)):
+            if not changed:
+                print("Package %s already has the same overrides - not updating Package" % edit.package.item_id)
 
     def list_overrides(self):
         for package in self._get_packages():
@@ -301,17 +387,16 @@ class App(pyacc.AccCommandLineApp):
             return self.list_overrides()
 
         if self.args.list:
+            property_index = pyacc.BundlePropertyIndex(self.acc)
+
             for package in self.acc.packages_many(self.args.package_ids):
                 # TODO we could validate our overrides against the overrides in the bundle
                 for bundle in package.bundles():
                     if bundle["name"] == self.args.bundle:
 
                         print("# Base properties in bundle: %s version: %s" % (bundle["name"], bundle["version"]))
-                        profile = bundle.profile()
-                        profile.get_json()
-                        # print(profile)
 
-                        for prop in profile["properties"] or []:
+                        for prop in property_index.properties(bundle):
                             print("%s=%s" % (prop["name"], prop["value"] or ""))
                         print()
                         break
@@ -320,69 +405,38 @@ class App(pyacc.AccCommandLineApp):
                     break
             return
 
-        val_re = re.compile("^([#]?)(.*)=(.*)")
+        edits = []
 
         for package in self.acc.packages_many(self.args.package_ids):
             # package.get_json()
             # print(package)
-            # package.add_overrides(overrides)
-
-            if self.args.replace:
-                master = {}
-            else:
-                # Get the existing bundle overrides for this package
-                master = package["bundleOverrides"]
-
-            overrides = master.get(self.args.bundle)
 
-            existing_overrides = {}
+            edit = package.edit()
+            edits.append(edit)
 
-            if not overrides:
-                overrides = master[self.args.bundle] = {}
-            else:
-                print("overrides", overrides)
+            if self.args.replace:
+                edit.bundle_overrides = {}
 
-                # build a lookup of non hidden existing overrides
-                for bundle, properties_list in overrides.iteritems():
-                    for prop in properties_list or []:
-                        # print("%s%s=%s" % ("#" if prop["hidden"] else "", prop["name"], prop["value"]))
-                        if not prop["hidden"]:
-                            existing_overrides[prop["name"]] = prop
+            # The bundle overrides for this package, which will be sent to the Config Server if they change
+            overrides = pyacc.OverrideSet(edit.bundle_overrides)
 
             if self.args.preamble:
-                overrides["preamble"] = self.args.preamble
+                overrides.set_preamble(self.args.bundle, self.args.preamble)
 
             # loop over the overrides we want to add
             for prop in self.args.properties:
-                prop_split = val_re.split(prop)
-
-                hidden = prop_split[1] == "#"
-                name = prop_split[2]
-                value = prop_split[3]
-
-                properties = overrides.get("properties")
-
-                if not properties:
-                    properties = overrides["properties"] = []
-
-                if not hidden:
-                    # do any of our new properties replace the existing ones?
-                    existing = existing_overrides.get(prop_split[2])
-
-                    if existing:
-                        # update the one that is there
-                        print("Updating existing override %s from %s to %s" % (name, existing["value"], value))
-                        existing["value"] = value
-                        continue
+                hidden, name, value = pyacc.split_property(prop)
 
-                prop_dic = {"description": None,
-                            "hidden": hidden,
-                            "name":  name,
-                            "value": value}
+                # do any of our new properties replace the existing ones?
+                existing = dict(overrides.get(self.args.bundle, name) or {})
 
-                properties.append(prop_dic)
+                if overrides.override(self.args.bundle, name, value, hidden) and existing:
+                    print("Updating existing override %s from %s%s to %s%s" % (
+                        name, "#" if existing["hidden"] else "", existing["value"], "#" if hidden else "", value))
 
-            package.add_overrides(master)
+        for edit, changed in zip(edits, pyacc.apply_package_edits(edits, self.acc.workers)):
+            if not changed:
+                print("Overrides of package %s would be unchanged - not updating Package" % edit.package.item_id)
 
     def main(self):
 
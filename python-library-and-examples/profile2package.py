@@ -3,17 +3,10 @@
 from __future__ import print_function
 
 import pyacc
-import pickle
-import os
 import sys
-import re
-
-from distutils.version import LooseVersion
 
 from pyacc import safe
 
-CACHE_FILE = "/tmp/bundle_property_cache"
-
 
 class App(pyacc.AccCommandLineApp):
     """
@@ -47,7 +40,15 @@ class App(pyacc.AccCommandLineApp):
     def make_property_map(self):
         bm = {}
 
-        for bundle in self.acc.bundles():
+        # The bundle properties are kept in a persistent index so only
+        # bundles we have not seen before need their profile fetching
+        bundles = list(self.acc.bundles())
+
+        print("Reading bundle property index")
+        property_index = pyacc.BundlePropertyIndex(self.acc)
+        property_index.refresh(bundles)
+
+        for bundle in bundles:
 
             if self.args.verbose:
                 bundle["id"]
@@ -68,26 +69,22 @@ class App(pyacc.AccCommandLineApp):
                     # safe(bundle["dependencies"]),
                 ]))
 
-            profile = bundle.profile()
-            # profile.get_json()
-            # print(profile)
-
             # The map looks like this
             # {"propname": {"bundlename}": {"bundleversion"}: bundle }}
 
             # i.e. property name -> bundle name -> bundle version
             bundle.profile_map = {}
-            print("Bundle %s:%s" % (bundle["name"], bundle["version"]))
 
-            for prop in profile["properties"] or []:
+            for prop in property_index.properties(bundle):
                 if not prop["hidden"]:
                     # print(prop)
                     bundle_entry = bm.setdefault(prop["name"], {})
                     bundle_entry2 = bundle_entry.setdefault(bundle["name"], {})
                     bundle_entry2.setdefault(bundle["version"], bundle)
 
-                    # Save a map of the properties within the bundle object so they get saved in the pickle
-                    print("  %s=%s" % (prop["name"], prop["value"]))
+                    # Save a map of the properties within the bundle object
+                    if self.args.verbose:
+                        print("  %s=%s" % (prop["name"], prop["value"]))
                     bundle.profile_map[prop["name"]] = prop["value"]
 
         # print("This is the big map")
@@ -183,50 +180,20 @@ class App(pyacc.AccCommandLineApp):
                 return v
             else:
                 # Pick the highest version
-                vmax = None
-                for version, bundle in versions.iteritems():
-                    v = LooseVersion(version), bundle
-                    print("Have %s" % v[0])
-                    if not vmax:
-                        vmax = v
-                    elif v[0] > vmax[0]:
-                        vmax = v
-                    else:
-                        # stick with what we've got
-                        pass
-                if vmax:
-                    print("Selected %s:%s" % (vmax[1]["name"], vmax[1]["version"]))
-                    return vmax[1]
+                if versions:
+                    vmax = max(versions.itervalues(), key=lambda bundle: pyacc.version_sort_key(bundle["version"]))
+                    print("Have %s" % ", ".join(sorted(versions, key=pyacc.version_sort_key)))
+                    print("Selected %s:%s" % (vmax["name"], vmax["version"]))
+                    return vmax
 
         return None
 
-    def split_property(self, prop):
-        prop_split = self.val_re.split(prop)
-        # print("prop_split", prop_split)
-
-        hidden = prop_split[1] == "#"
-        name = prop_split[2].strip()
-        value = prop_split[3].strip()
-        return hidden, name, value
-
     def main(self):
-        self.val_re = re.compile("^([#]?)(.*)=(.*)")
-
         self.included_bundles = {}
         self.appserver = None
         self.overrides = {}
 
-        if os.path.exists(CACHE_FILE):
-            print("Reading bundle property index from cache", CACHE_FILE)
-
-            with open(CACHE_FILE, "r") as fin:
-                self.bm = pickle.load(fin)
-        else:
-            print("Building bundle property index", CACHE_FILE)
-            self.bm = self.make_property_map()
-
-            with open(CACHE_FILE, "w") as fout:
-                pickle.dump(self.bm, fout)
+        self.bm = self.make_property_map()
 
         if self.args.introscope_profile:
             for name in self.args.introscope_profile:
@@ -239,19 +206,15 @@ class App(pyacc.AccCommandLineApp):
 
     def do_one(self, fileobj):
 
-        for raw in fileobj:
-            line = raw.strip()
-            if not line or line[0] == "#":
-                continue
-            try:
-                hidden, name, value = self.split_property(line)
-                if not hidden:
-                    print("\nSearching for %s(=%s)" % (name, value))
-                    self.lookup(name, value)
-                else:
-                    print("Skip hidden property %s" % name)
-            except IndexError as e:
-                print("Failed to process", line.strip())
+        # Commented out (hidden) properties are skipped by the parser
+        properties, warnings = pyacc.read_properties_file(fileobj)
+
+        for warning in warnings:
+            print("WARNING: %s" % warning)
+
+        for name, value in properties:
+            print("\nSearching for %s(=%s)" % (name, value))
+            self.lookup(name, value)
 
         print("\ndetected appserver is %s\n" % self.appserver)
 
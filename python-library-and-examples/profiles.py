@@ -29,14 +29,20 @@ class App(pyacc.AccCommandLineApp):
             # This will fetch all agents (a page a time)
             bundles = self.acc.bundles()
 
+        # The bundle properties are kept in a persistent index so only
+        # bundles we have not seen before need their profile fetching
+        property_index = pyacc.BundlePropertyIndex(self.acc)
+
+        bundles = list(bundles)
+        property_index.refresh(bundles, verbose=False)
+
         for bundle in bundles:
 
             # Print the bundle details
             # bundle["id"]
             # print("Bundle:", bundle)
 
-            p = bundle.profile()
-            props = p["properties"]
+            props = property_index.properties(bundle)
 
             if props:
                 # print(bundle)
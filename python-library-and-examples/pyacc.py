@@ -15,6 +15,7 @@ REST calls.
 Features:
     Automatic page handling.
     Lazy ACC objects - fetched from the server as they are used.
+    Compact read-only records for scanning large numbers of agents etc (see JsonRecord).
     Command line building classes - write a ACC command line app just a few lines of code,
     including profiles for saving access tokens.
 
@@ -44,20 +45,42 @@ from __future__ import print_function
 
 import os
 import sys
+import array
+import bisect
+import calendar
+import contextlib
+import copy
 import errno
+import hashlib
+import itertools
 import argparse
 import urlparse
 import urllib
 import httplib
 import json
 import pprint
+import re
+import shutil
 import mimetypes
+import multiprocessing
 import datetime
+import tarfile
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where saves of shared cache files are not serialised between processes
+    fcntl = None
+
 SERVER_URL = "https://example.com:8443"  # Can be http/8088 if security switch off on the Config Server
 SECURITY_TOKEN = ""  # you will need to generate your own.  See createApiSecurityToken.py
 PAGE_SIZE = 20
+WORKERS = 8  # number of concurrent requests made to the Config Server by parallel_map etc
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.acc', 'cache')
 debug_mode = False
 
 
@@ -110,7 +133,11 @@ def safe(val):
     return str(val)
 
 
-def write_content_to_file(res, filename, overwrite=False, chunk_size=1048576):
+def write_content_to_file(res, filename, overwrite=False, chunk_size=1048576, verbose=True):
+    """
+    Write the content of a response to a file. Pass verbose=False to not print progress,
+    e.g. when several downloads are running at once.
+    """
 
     # print("response headers:")
     # print(res.msg)
@@ -119,25 +146,30 @@ def write_content_to_file(res, filename, overwrite=False, chunk_size=1048576):
         print("Skipping writing existing:", filename)
     else:
         content_length = long(res.msg["content-length"])
-        print("Content length is", content_length);
+        if verbose:
+            print("Content length is", content_length);
 
         with open(filename, "wb") as fout:
-            print("Fetching payload to:", filename)
-            print("-" * ((content_length * 2 / chunk_size) + 2))
+            if verbose:
+                print("Fetching payload to:", filename)
+                print("-" * ((content_length * 2 / chunk_size) + 2))
 
             while 1:
-                print("r", end="")
-                sys.stdout.flush()
+                if verbose:
+                    print("r", end="")
+                    sys.stdout.flush()
 
                 content = res.read(chunk_size)
                 if not content:
                     break
 
-                print("w", end="")
-                sys.stdout.flush()
+                if verbose:
+                    print("w", end="")
+                    sys.stdout.flush()
 
                 fout.write(content)
-        print()
+        if verbose:
+            print()
 
 
 def parse_date(date):
@@ -148,6 +180,17 @@ def parse_date(date):
     return datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%fZ")
 
 
+def parse_timestamp(date):
+    """
+    Fast conversion of a date as returned from the rest api (see parse_date)
+    to seconds since the epoch (UTC). Returns 0 if there is no date.
+    """
+    if not date:
+        return 0.0
+    return calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                            int(date[11:13]), int(date[14:16]), int(date[17:19]))) + float(date[19:-1] or 0)
+
+
 def get_filename_from_content_disp(res):
     cdisp = [h.strip() for h in res.msg["content-disposition"].split(";")]
     for c in cdisp:
@@ -158,6 +201,368 @@ def get_filename_from_content_disp(res):
     return filename or "unknown"
 
 
+def stream_digest(fileobj, chunk_size=1048576):
+    """Return the sha1 hex digest of the content read from a file object"""
+    sha1 = hashlib.sha1()
+    for chunk in iter(lambda: fileobj.read(chunk_size), ""):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def file_digest(filename, chunk_size=1048576):
+    """Return the sha1 hex digest of the content of a file"""
+    with open(filename, "rb") as fin:
+        return stream_digest(fin, chunk_size)
+
+
+class TeeReader(object):
+
+    """
+    A file object which copies everything read from another one (e.g. a response) to a file and
+    digests it, so the content can be read, e.g. by tarfile, while it is being downloaded.
+    """
+
+    def __init__(self, fileobj, fout):
+        self.fileobj = fileobj
+        self.fout = fout
+        self.sha1 = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size) if size >= 0 else self.fileobj.read()
+        self.fout.write(data)
+        self.sha1.update(data)
+        return data
+
+    def drain(self, chunk_size=1048576):
+        """Read (and so copy) whatever the reader of the content didn't need"""
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the file at path (which is created if need be) against other processes"""
+    with open(path, "a") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield  # closing the file releases the lock
+
+
+def bundle_archive_members(filename, fileobj=None):
+    """
+    Return [name, digest] for the files (not directories) in a bundle archive, digest being
+    the sha1 hex digest of the content of regular files and None for anything else.
+    The archive is read from fileobj if it is given, which need only support read.
+    """
+    members = []
+    with tarfile.open(filename, "r|*", fileobj=fileobj) as btf:
+        for ti in btf:
+            if ti.isfile():
+                members.append([ti.name, stream_digest(btf.extractfile(ti))])
+            elif not ti.isdir():
+                members.append([ti.name, None])
+    return members
+
+
+# Java properties syntax (see java.util.Properties.load): a key ends at the first unescaped "=", ":" or
+# white space, which may be followed by white space, one "=" or ":" and more white space before the value.
+PROPERTY_WHITESPACE = " \t\f"
+PROPERTY_RE = re.compile(r"([^=: \t\f]*)[ \t\f]*[=:]?[ \t\f]*(.*)$", re.DOTALL)
+PROPERTY_ESCAPES = {"t": "\t", "n": "\n", "r": "\r", "f": "\f"}
+
+# A directive in a toggles file, e.g. "TurnOn: ServerInfoTracing"
+TOGGLE_DIRECTIVE_RE = re.compile(r"([A-Za-z]+):[ \t]*(.*)$")
+
+# Bump this when the parsers change so results cached by older versions are not used
+PARSER_VERSION = 1
+PARSED_CACHE_DIR = os.path.join(CACHE_DIR, "parsed")
+
+# key -> (properties, warnings) for the files read by read_properties_file in this process
+parsed_files = {}
+
+
+def warn(warnings, message):
+    if warnings is None:
+        print("WARNING:", message)
+    else:
+        warnings.append(message)
+
+
+def unescape_property(text, warnings=None):
+    """Replace the escapes in a property key or value, \\uxxxx escapes becoming UTF-8"""
+    if "\\" not in text:
+        return text
+
+    out = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        i += 1
+
+        if c != "\\":
+            out.append(c)
+        elif i < len(text):
+            c = text[i]
+            i += 1
+
+            if c == "u":
+                try:
+                    out.append(unichr(int(text[i:i + 4], 16)).encode("UTF-8"))
+                    i += 4
+                except ValueError:
+                    warn(warnings, "Malformed \\uxxxx escape in: %s" % text)
+                    out.append("\\u")
+            else:
+                out.append(PROPERTY_ESCAPES.get(c, c))
+
+    return "".join(out)
+
+
+def split_property_line(line, warnings=None):
+    """Split a logical line of a properties file (without leading white space) into (key, value)"""
+    if "\\" not in line:
+        return PROPERTY_RE.match(line).groups()
+
+    # The end of the key might be escaped, so look for it a character at a time
+    i = 0
+    while i < len(line):
+        if line[i] == "\\":
+            i += 2
+        elif line[i] in "=:" or line[i] in PROPERTY_WHITESPACE:
+            break
+        else:
+            i += 1
+
+    value = line[i:].lstrip(PROPERTY_WHITESPACE)
+    if value[:1] in ("=", ":") and value:
+        value = value[1:].lstrip(PROPERTY_WHITESPACE)
+
+    return unescape_property(line[:i], warnings), unescape_property(value, warnings)
+
+
+def split_property(text):
+    """
+    Split a single property given as "name=value" following the properties file rules,
+    "#name=value" meaning a hidden property. Returns (hidden, name, value).
+    """
+    hidden = text.startswith("#")
+    name, value = split_property_line((text[1:] if hidden else text).lstrip(PROPERTY_WHITESPACE))
+    return hidden, name, value
+
+
+def parse_properties(lines, warnings=None):
+    """
+    Parse a Java properties file such as IntroscopeAgent.profile as a stream of lines (e.g. a file object),
+    yielding (name, value) for each property in the order they appear. Comment lines (# or !) are skipped,
+    lines ending in an odd number of backslashes continue on the next line and escapes are replaced.
+    Problems are added to warnings, or printed if it is None.
+    """
+    logical = None
+
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+
+        if logical is None:
+            line = line.lstrip(PROPERTY_WHITESPACE)
+            if not line or line[0] in "#!":
+                continue
+        else:
+            line = logical + line.lstrip(PROPERTY_WHITESPACE)
+
+        if (len(line) - len(line.rstrip("\\"))) % 2:
+            logical = line[:-1]
+            continue
+
+        logical = None
+        yield split_property_line(line, warnings)
+
+    if logical is not None:
+        yield split_property_line(logical, warnings)
+
+
+def parse_toggles(lines, warnings=None):
+    """
+    Parse an agent toggles file (.pbd or .pbl) as a stream of lines, yielding ("instrument.<name>", "on")
+    for each TurnOn directive. Other directives, and the files listed in a .pbl, are skipped.
+    Lines which are none of these are added to warnings, or printed if it is None.
+    """
+    for raw in lines:
+        line = raw.strip()
+
+        if not line or line[0] == "#" or line.endswith((".pbd", ".pbl")):
+            continue
+
+        match = TOGGLE_DIRECTIVE_RE.match(line)
+
+        if not match:
+            warn(warnings, "Not sure what this is in toggles file: %s" % line)
+        elif match.group(1) == "TurnOn":
+            if match.group(2):
+                yield "instrument.%s" % match.group(2), "on"
+            else:
+                warn(warnings, "Missing name in toggles file: %s" % line)
+
+
+def read_properties_file(fileobj, toggles=False, directory=None):
+    """
+    Read and parse a profile, or a toggles file if toggles is set, returning (properties, warnings) where
+    properties is a list of (name, value). Results are memoized by the digest of the content, in memory
+    and under ~/.acc/cache/parsed, so the same file found in many archives, or by later runs, is only
+    parsed once.
+    """
+    content = fileobj.read()
+    key = "%s-%s-v%d" % ("toggles" if toggles else "profile", hashlib.sha1(content).hexdigest(), PARSER_VERSION)
+
+    result = parsed_files.get(key)
+    if result is not None:
+        return result
+
+    path = os.path.join(directory or PARSED_CACHE_DIR, key + ".json")
+
+    # Files are bytes (ISO 8859-1 for properties files) so are stored as latin-1 to round trip exactly
+    try:
+        with open(path, "rt") as fin:
+            cached = json.load(fin, encoding="latin-1")
+        result = ([(name.encode("latin-1"), value.encode("latin-1")) for name, value in cached["properties"]],
+                  [warning.encode("latin-1") for warning in cached["warnings"]])
+    except (IOError, ValueError, KeyError):
+        warnings = []
+        parse = parse_toggles if toggles else parse_properties
+        result = (list(parse(content.splitlines(), warnings)), warnings)
+
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700)
+
+            temp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+            with open(temp_path, "wt") as fout:
+                json.dump({"properties": result[0], "warnings": result[1]}, fout, encoding="latin-1")
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            debug("Could not cache parsed file %s: %s" % (path, e))
+
+    parsed_files[key] = result
+    return result
+
+
+# The components of a version, as split by distutils' LooseVersion
+VERSION_COMPONENT_RE = re.compile(r"(\d+|[a-z]+|\.)")
+
+# version string -> version_key
+version_keys = {}
+
+
+def version_key(version):
+    """
+    A sortable key for a bundle or agent version, ordered like LooseVersion: numeric components
+    compare as numbers and before any others. Trailing zero components are ignored so 10.2 and
+    10.2.0 are equal (LooseVersion put 10.2 first), which is what matching versions wants.
+    Use version_sort_key to put versions in a definite order. Keys are worked out once for each
+    version string and then reused.
+    """
+    key = version_keys.get(version)
+
+    if key is None:
+        components = [int(c) if c.isdigit() else c
+                      for c in VERSION_COMPONENT_RE.split(str(version).strip()) if c and c != "."]
+        while len(components) > 1 and components[-1] == 0:
+            components.pop()
+        key = version_keys[version] = tuple(components)
+
+    return key
+
+
+def version_sort_key(version):
+    """
+    Like version_key but versions which are equal, e.g. 10.2 and 10.2.0, are ordered by the version
+    string so sorting, max etc. always give the same result (10.2.0 is the later of those two)
+    """
+    return version_key(version), str(version)
+
+
+def parallel_map(func, items, workers=WORKERS):
+    """
+    Call func for each of the items using a pool of threads and return the results
+    in the same order as the items. Useful for making many independent REST calls.
+    """
+    items = list(items)
+
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class JsonFileCache(object):
+
+    """
+    A dictionary which is persisted as a json file, e.g. under ~/.acc/cache.
+    Only use this for data which does not change once it has been created on the
+    Config Server as nothing is ever invalidated.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.path, "rt") as fin:
+                    self.data = json.load(fin)
+                debug("Read %d cache entries from %s" % (len(self.data), self.path))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.data = {}
+            except ValueError:
+                print("WARNING: Ignoring corrupt cache file", self.path)
+                self.data = {}
+        return self.data
+
+    def save(self, merge=False):
+        """
+        Write the entries to the file. With merge, entries which another process has saved
+        since the file was read are kept as well (ours win), rather than the last save winning.
+        """
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0o700)
+
+        data = self.load()
+
+        with file_lock(self.path + ".lock"):
+            if merge:
+                self.data = None
+                self.load().update(data)
+
+            # Write to a temporary file first so a concurrent reader never sees half a file
+            temp_path = "%s.%d.%d.tmp" % (self.path, os.getpid(), threading.current_thread().ident)
+            with open(temp_path, "wt") as fout:
+                json.dump(self.data, fout)
+            os.rename(temp_path, self.path)
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.load()
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __setitem__(self, key, value):
+        self.load()[key] = value
+
+
 class AccRaw(object):
 
     """
@@ -362,11 +767,15 @@ class AccApi(AccRaw):
         self.info.get_json()
         return str(self.info)
 
-    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20):
+    def __init__(self, server=SERVER_URL, token=SECURITY_TOKEN, page_size=20, workers=WORKERS):
         super(AccApi, self).__init__(server, token, page_size)
 
         debug("Server: %s Token %s" % (server, token))
 
+        self.workers = workers
+        self.pool = None
+        self.artifacts = None
+
         self.info = AccInfo(self)
 
     def __getitem__(self, key):
@@ -377,48 +786,122 @@ class AccApi(AccRaw):
         return Agent(self, item_id)
 
     def agents(self, **kwargs):
-        """Fetch agents meta-data as Agent objects"""
+        """
+        Fetch agents meta-data as Agent objects.
+        Pass fields=[...] to only keep the given json fields (see PagedJsonObject)
+        """
         return Agents(self, None, **kwargs)
 
+    def agent_table(self, **kwargs):
+        """Fetch agents meta-data into a columnar AgentTable for analysis"""
+        return AgentTable(self.agents(**kwargs).json_items())
+
     def agents_many(self, agent_ids):
         """Factory to create lots of Agent objects from a list of agent ids"""
-        return [Agent(self, agent_id) for agent_id in agent_ids]
+        return LazyList(self, [Agent(self, agent_id) for agent_id in agent_ids])
 
     def audit_records(self, **kwargs):
         """Fetch agents meta-data"""
         return AuditRecords(self, None, **kwargs)
 
     def audit_records_many(self, audit_record_ids):
-        return [AuditRecord(self, audit_record_id) for audit_record_id in audit_record_ids]
+        return LazyList(self, [AuditRecord(self, audit_record_id) for audit_record_id in audit_record_ids])
 
     def bundle(self, item_id):
         return Bundle(self, item_id)
 
     def bundles(self, **kwargs):
-        """Fetch bundle meta-data as Bundle objects"""
+        """Fetch bundle meta-data as Bundle objects. Also takes fields=[...] (see agents)"""
         return Bundles(self, None, **kwargs)
 
+    def prefetch_profiles(self, bundles):
+        """
+        Fetch the profiles of the bundles concurrently. Each profile is held on its Bundle
+        (see Bundle.profile) so later use does not go to the server. Bundle objects with
+        the same id share a single fetch.
+        """
+        same_id_bundles = {}
+        for bundle in bundles:
+            same_id_bundles.setdefault(str(bundle.item_id), []).append(bundle)
+
+        def fetch(same_bundles):
+            profile = same_bundles[0].profile()
+            profile.get_json()
+            for bundle in same_bundles[1:]:
+                bundle._profile = profile
+
+        parallel_map(fetch, same_id_bundles.values(), self.workers)
+
     def bundles_many(self, bundle_ids):
         """Factory to create lots of Bundle objects from a list of bundle ids"""
-        return [Bundle(self, bundle_id) for bundle_id in bundle_ids]
+        return LazyList(self, [Bundle(self, bundle_id) for bundle_id in bundle_ids])
 
     def controller(self, item_id):
         """Create a lazily initialized Controller object"""
         return Controller(self, item_id)
 
     def controllers(self, **kwargs):
-        """Fetch controller meta-data as Controller objects"""
+        """Fetch controller meta-data as Controller objects. Also takes fields=[...] (see agents)"""
         return Controllers(self, None, **kwargs)
 
     def controllers_many(self, controller_ids):
         """Easy way to create lots of lazily initialized Controller objects from a list of ids"""
-        return [Controller(self, agent_id) for agent_id in controller_ids]
+        return LazyList(self, [Controller(self, agent_id) for agent_id in controller_ids])
 
     def controller_from_upgrade_id(self, upgrade_id):
         """Get a controller from the upgrade id"""
         json_obj = self.http_get_json("/apm/acc/controllerUpgradeTask", str(upgrade_id) + "/controller")
         return Controller(self, json_obj)
 
+    def controller_ids_from_upgrade_ids(self, upgrade_ids):
+        """
+        Map upgrade task ids to the id of the controller being upgraded.
+        The mapping never changes once a task has been created so it is cached
+        in ~/.acc/cache and only unknown tasks are requested (concurrently) from the server.
+        """
+        cache = self.cache("controllerUpgradeTask-controller")
+
+        unresolved = [str(upgrade_id) for upgrade_id in upgrade_ids if str(upgrade_id) not in cache]
+
+        if unresolved:
+            debug("Resolving controllers for %d upgrade tasks" % len(unresolved))
+
+            controller_ids = parallel_map(lambda upgrade_id: self.controller_from_upgrade_id(upgrade_id)["id"],
+                                          unresolved, self.workers)
+
+            for upgrade_id, controller_id in zip(unresolved, controller_ids):
+                cache[upgrade_id] = controller_id
+            cache.save()
+
+        return dict((upgrade_id, str(cache[str(upgrade_id)])) for upgrade_id in upgrade_ids)
+
+    def background_pool(self):
+        """Thread pool used for fetching objects in the background (see LazyList)"""
+        if not self.pool:
+            self.pool = ThreadPool(self.workers)
+        return self.pool
+
+    def close(self):
+        """Stop the background_pool threads, waiting for any fetches in progress to finish"""
+        pool, self.pool = self.pool, None
+        if pool:
+            pool.close()
+            pool.join()
+
+    def artifact_cache(self):
+        """The ArtifactCache for package and controller archives downloaded from this Config Server"""
+        if not self.artifacts:
+            self.artifacts = ArtifactCache(self)
+        return self.artifacts
+
+    def cache(self, name):
+        """Return a JsonFileCache for data belonging to this Config Server"""
+        return JsonFileCache(os.path.join(self.cache_dir(), name + ".json"))
+
+    def cache_dir(self):
+        """Directory under ~/.acc/cache for data belonging to this Config Server"""
+        return os.path.join(CACHE_DIR, self.url.netloc.replace(":", "_"))
+
     def diagnostic_report(self, item_id):
         """Create a lazily initialized DiagnosticReport object"""
         return DiagnosticReport(self, item_id)
@@ -432,7 +915,7 @@ class AccApi(AccRaw):
 
     def diagnostic_reports_many(self, report_ids):
         """Factory to create lots of DiagnosticReport objects from a list of report ids"""
-        return [DiagnosticReport(self, report_id) for report_id in report_ids]
+        return LazyList(self, [DiagnosticReport(self, report_id) for report_id in report_ids])
 
     def download_file(self, file_id):
         """Download file with the given file_id"""
@@ -448,31 +931,34 @@ class AccApi(AccRaw):
                 archive_type = "zip"
 
         fname = "acc-controller-package.%s" % archive_type
-        res = self.http_get("/apm/acc/controllerPackage/", fname)
 
-        if not filename:
-            filename = fname
+        def download(temp_path):
+            res = self.http_get("/apm/acc/controllerPackage/", fname)
+            write_content_to_file(res, temp_path)
+            return fname
 
-        write_content_to_file(res, filename)
+        # The controller package only changes when the Config Server is upgraded
+        key = "controller/%s/%s" % (self["serverVersion"], archive_type)
 
-        return filename
+        return self.artifact_cache().get(key, "", filename or fname, download)
 
     def files(self, **kwargs):
         """Get all available files"""
         return Files(self, None, **kwargs)
 
     def file_meta_many(self, file_ids):
-        return [FileMeta(self, file_id) for file_id in file_ids]
+        return LazyList(self, [FileMeta(self, file_id) for file_id in file_ids])
 
     def package(self, item_id):
         return Package(self, item_id)
 
     def packages(self, **kwargs):
+        """Fetch package meta-data as Package objects. Also takes fields=[...] (see agents)"""
         return Packages(self, None, **kwargs)
 
     def packages_many(self, package_ids):
         """Factory to create lots of Package objects from a list of package ids"""
-        return [Package(self, package_id) for package_id in package_ids]
+        return LazyList(self, [Package(self, package_id) for package_id in package_ids])
 
     def package_create(self, name, os, appserver, em_host, agent_version, process_display_name, comment, draft):
 
@@ -498,7 +984,7 @@ class AccApi(AccRaw):
         return SecurityTokens(self, None, **kwargs)
 
     def security_tokens_many(self, sec_ids):
-        return [SecurityToken(self, sec_id) for sec_id in sec_ids]
+        return LazyList(self, [SecurityToken(self, sec_id) for sec_id in sec_ids])
 
     def upload_file(self, filename):
         fields = [("name", os.path.basename(filename)),
@@ -566,6 +1052,439 @@ class AccApi(AccRaw):
                 yield task
 
 
+class ArtifactCache(object):
+
+    """
+    A local store of downloaded package and controller archives under ~/.acc/cache/artifacts,
+    shared by all Config Servers.
+
+    Archives are stored under the sha1 digest of their content. Each Config Server has an index
+    (~/.acc/cache/<server>/artifacts.json) of key -> {"filename": name the server gave it,
+    "digest": digest}, so an archive the server has already built for us is never requested again.
+    Archives are served by hard linking them to the requested filename, or copying them where
+    that isn't possible, which means a served file edited in place also changes the stored
+    archive. So an archive is checked against its digest before it is served and downloaded
+    again if it doesn't match.
+    """
+
+    def __init__(self, accapi, directory=None):
+        self.accapi = accapi
+        self.directory = directory or os.path.join(CACHE_DIR, "artifacts")
+        self.index = accapi.cache("artifacts")
+        self.lock = threading.Lock()
+
+    def archive_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def filename(self, key):
+        """Return the name the server gave the archive for the key if it has been downloaded before"""
+        with self.lock:
+            entry = self.index.get(key)
+        return entry and utf8(entry["filename"])
+
+    def lookup(self, key):
+        """Return the index entry for the key if its archive is in the store and intact, otherwise None"""
+        with self.lock:
+            entry = self.index.get(key)
+
+        if entry:
+            archive = self.archive_path(entry["digest"])
+            if os.path.exists(archive) and file_digest(archive) == entry["digest"]:
+                return entry
+
+            print("WARNING: Ignoring missing or modified cached archive for", key)
+
+        return None
+
+    def add(self, key, download):
+        """
+        Download an archive into the store and return its index entry.
+        download(filename) must write the archive to filename and return the name the server gave it.
+        """
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        temp_path = os.path.join(self.directory, "%d.%d.download" % (os.getpid(), threading.current_thread().ident))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)  # left behind by an earlier failed download
+
+        try:
+            name = download(temp_path)
+            digest = file_digest(temp_path)
+            os.rename(temp_path, self.archive_path(digest))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        entry = {"filename": name, "digest": digest}
+
+        with self.lock:
+            self.index[key] = entry
+            self.index.save(merge=True)
+
+        return entry
+
+    def serve(self, entry, filename, overwrite=False):
+        """Link or copy the archive of an index entry to filename"""
+        archive = self.archive_path(entry["digest"])
+
+        if os.path.exists(filename):
+            if not overwrite:
+                print("Skipping writing existing:", filename)
+                return
+            if os.path.samefile(archive, filename):
+                return
+            os.remove(filename)
+
+        try:
+            os.link(archive, filename)
+        except (AttributeError, OSError):
+            # No hard links on this platform or file system, or a different device
+            shutil.copyfile(archive, filename)
+
+    def get(self, key, directory, filename, download, overwrite=False, verbose=True):
+        """
+        Put the archive for the key in directory, downloading it first if it isn't in the store.
+        The name the server gave the archive is used if filename is None. Returns the filename.
+        """
+        return self.fetch(key, directory, filename, download, overwrite, verbose)[0]
+
+    def fetch(self, key, directory, filename, download, overwrite=False, verbose=True):
+        """
+        As get, but returns (filename, from_cache) where from_cache is False if the archive had to be
+        downloaded, including when the cached copy was missing or failed its digest check.
+        """
+        entry = self.lookup(key)
+        from_cache = entry is not None
+
+        if from_cache:
+            if verbose:
+                print("Using cached archive for", key)
+        else:
+            entry = self.add(key, download)
+
+        filename = os.path.join(directory, filename or utf8(entry["filename"]))
+        self.serve(entry, filename, overwrite)
+
+        return filename, from_cache
+
+
+class BundleStore(object):
+
+    """
+    A local store of bundle archives under ~/.acc/cache/bundles, shared by all Config Servers.
+
+    Archives are stored under the sha1 digest of their content, along with an index of
+    the files each one contains and the digest of each file's content, so an archive is
+    only ever downloaded and indexed once.
+    Each Config Server also has a cached map of bundle id to name, version and digest so
+    bundles that have been seen before need no requests at all. Bundles which are new,
+    or whose name or version no longer match the cached entry, are downloaded again.
+    """
+
+    members_version = 2
+
+    def __init__(self, accapi, directory=None):
+        self.accapi = accapi
+        self.directory = directory or os.path.join(CACHE_DIR, "bundles")
+
+        # bundle id -> {"name": name, "version": version, "digest": digest} for this Config Server
+        self.bundles = accapi.cache("bundles")
+
+        # digest -> list of [file, digest of file] in the archive. The version is part of the
+        # name so a change of format means the stored archives are simply indexed again.
+        self.members = JsonFileCache(os.path.join(self.directory, "members-v%d.json" % self.members_version))
+
+    def archive_path(self, digest):
+        return os.path.join(self.directory, digest + ".tar.gz")
+
+    def known_digest(self, bundle):
+        """Return the digest of the bundle if it is already in the store, otherwise None"""
+        entry = self.bundles.get(str(bundle["id"]))
+
+        # An archive which has been removed from the store since is simply downloaded again
+        if entry and entry["name"] == bundle["name"] and entry["version"] == bundle["version"] and \
+                os.path.exists(self.archive_path(entry["digest"])):
+            return entry["digest"]
+
+        return None
+
+    def add(self, bundle):
+        """
+        Download the bundle into the store and return its digest and the list of its files
+        (see bundle_archive_members), which are read from the archive as it is downloaded.
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, 0o700)
+
+        download = os.path.join(self.directory, "%s.%d.%d.download" % (
+            bundle.item_id, os.getpid(), threading.current_thread().ident))
+
+        try:
+            res = self.accapi.http_get("/apm/acc/bundle", bundle.item_id, format="tar.gz")
+            with open(download, "wb") as fout:
+                tee = TeeReader(res, fout)
+                members = bundle_archive_members(download, tee)
+                tee.drain()
+        except:
+            if os.path.exists(download):
+                os.remove(download)
+            raise
+
+        digest = tee.hexdigest()
+
+        if os.path.exists(self.archive_path(digest)):
+            # Already have this content, e.g. the same bundle from another Config Server
+            os.remove(download)
+        else:
+            os.rename(download, self.archive_path(digest))
+
+        self.bundles[str(bundle["id"])] = {"name": bundle["name"], "version": bundle["version"], "digest": digest}
+
+        print("\tDownloaded %s:%s" % (bundle["name"], bundle["version"]))
+
+        return digest, members
+
+    def sync(self, bundles):
+        """
+        Make sure all the bundles are in the store and indexed, only downloading
+        those which are not. Returns the list of digests, in the same order as the bundles.
+
+        Missing bundles are downloaded concurrently (see --workers), each archive being
+        indexed as it downloads. Listing the files of an archive which is already in the
+        store means decompressing it which is CPU bound, so that is done in a pool of processes.
+        The index files are merged with any entries other processes have saved meanwhile.
+        """
+        bundles = list(bundles)
+        digests = [self.known_digest(bundle) for bundle in bundles]
+        missing = [bundle for bundle, digest in zip(bundles, digests) if not digest]
+
+        self.members.load()
+
+        # digest -> pending list of [file, digest of file] in the archive
+        indexing = {}
+        index_pool = None
+
+        # (bundle, error) for each bundle which could not be downloaded
+        failed = []
+
+        def download(bundle):
+            try:
+                return bundle, self.add(bundle), None
+            except (ACCException, EnvironmentError, tarfile.TarError) as e:
+                return bundle, None, e
+
+        if [digest for digest in digests if digest and digest not in self.members]:
+            # Create the process pool before we start any threads of our own
+            index_pool = multiprocessing.Pool()
+
+        try:
+            for digest in digests:
+                if digest and digest not in self.members and digest not in indexing:
+                    indexing[digest] = index_pool.apply_async(bundle_archive_members, (self.archive_path(digest),))
+
+            if missing:
+                print("\tDownloading %d bundles" % len(missing))
+                download_pool = ThreadPool(min(self.accapi.workers, len(missing)))
+                try:
+                    for bundle, added, error in download_pool.imap_unordered(download, missing):
+                        if error:
+                            failed.append((bundle, error))
+                        else:
+                            digest, members = added
+                            self.members[digest] = members
+                finally:
+                    download_pool.close()
+                    download_pool.join()
+
+            if indexing:
+                print("\tIndexing %d bundles" % len(indexing))
+                for digest, members in indexing.iteritems():
+                    self.members[digest] = members.get()
+        finally:
+            if index_pool:
+                index_pool.close()
+                index_pool.join()
+
+            # Keep what was downloaded and indexed, even if something failed
+            self.bundles.save(merge=True)
+            self.members.save(merge=True)
+
+        if failed:
+            for bundle, error in failed:
+                print("\tERROR: Failed to download %s:%s: %s" % (bundle["name"], bundle["version"], error))
+            raise ACCException("Failed to download %d of %d bundles" % (len(failed), len(missing)))
+
+        return [self.digest(bundle) for bundle in bundles]
+
+    def digest(self, bundle):
+        digest = self.known_digest(bundle)
+        if not digest:
+            raise ACCException("Bundle %s:%s is not in the bundle store" % (bundle["name"], bundle["version"]))
+        return digest
+
+    def archive(self, bundle):
+        """Return the filename of the archive of a bundle in the store"""
+        return self.archive_path(self.digest(bundle))
+
+    def files(self, bundle):
+        """Return the names of the files in a bundle in the store"""
+        return [name for name, content_digest in self.file_digests(bundle)]
+
+    def file_digests(self, bundle):
+        """Return (name, digest) for the files in a bundle in the store, see bundle_archive_members"""
+        return [(name, content_digest) for name, content_digest in utf8(self.members[self.digest(bundle)])]
+
+
+class BundlePropertyIndex(object):
+
+    """
+    A persistent index of the IntroscopeAgent.profile properties of the bundles on a
+    Config Server (~/.acc/cache/<server>/bundle-properties.json).
+
+    Entries are keyed by bundle id and only (re)fetched for bundles which are new or whose
+    name or version has changed. Only plain data is kept for each property: its name,
+    value, hidden flag, key and description.
+    """
+
+    property_fields = ("name", "value", "hidden", "key", "description")
+
+    def __init__(self, accapi):
+        self.accapi = accapi
+        self.cache = accapi.cache("bundle-properties")
+
+        # bundle id -> properties, converted to UTF-8
+        self.converted = {}
+
+        # The index may be shared by threads building different packages
+        self.lock = threading.RLock()
+
+    def _entry(self, bundle):
+        entry = self.cache.get(str(bundle["id"]))
+
+        if entry and entry["name"] == bundle["name"] and entry["version"] == bundle["version"]:
+            return entry
+
+        return None
+
+    def refresh(self, bundles, verbose=True):
+        """Fetch the properties of any of the bundles which are not already in the index"""
+        with self.lock:
+            missing = [bundle for bundle in bundles if not self._entry(bundle)]
+
+            if verbose and missing:
+                print("\tReading properties for %d bundles" % len(missing))
+
+            self.accapi.prefetch_profiles(missing)
+
+            for bundle in missing:
+                if verbose:
+                    print("\tRead properties for bundle %s:%s" % (bundle["name"], bundle["version"]))
+
+                properties = [dict((field, prop.get(field)) for field in self.property_fields)
+                              for prop in bundle.profile()["properties"] or []]
+
+                self.cache[str(bundle["id"])] = {"name": bundle["name"],
+                                                 "version": bundle["version"],
+                                                 "properties": properties}
+                self.converted.pop(str(bundle["id"]), None)
+
+            if missing:
+                self.cache.save()
+
+    def properties(self, bundle):
+        """Return the list of properties of the bundle, each a dictionary of property_fields"""
+        bundle_id = str(bundle["id"])
+
+        if bundle_id not in self.converted:
+            if not self._entry(bundle):
+                self.refresh([bundle])
+
+            self.converted[bundle_id] = utf8(self.cache[bundle_id]["properties"])
+
+        return self.converted[bundle_id]
+
+
+class BundleVersionIndex(object):
+
+    """
+    The versions of each bundle, sorted by version_sort_key, so the latest version of a bundle, a given
+    version or the versions in a range are found by bisection rather than by comparing every version.
+    Finding the latest version which passes some other test (see latest) still checks them one by one.
+    Versions with the same version_key (e.g. 10.2 and 10.2.0) are in the order of their version strings.
+    """
+
+    def __init__(self, bundles=()):
+        # name -> sorted list of version keys, and the bundles in the same order
+        self.keys = {}
+        self.bundles = {}
+
+        by_name = {}
+        for bundle in bundles:
+            by_name.setdefault(bundle["name"], []).append(bundle)
+
+        for name, versions in by_name.iteritems():
+            versions.sort(key=lambda bundle: version_sort_key(bundle["version"]))
+            self.keys[name] = [version_key(bundle["version"]) for bundle in versions]
+            self.bundles[name] = versions
+
+    def add(self, bundle):
+        name = bundle["name"]
+        keys = self.keys.setdefault(name, [])
+        versions = self.bundles.setdefault(name, [])
+        key = version_key(bundle["version"])
+
+        # Among equal versions, go by the version string as version_sort_key does
+        i = bisect.bisect_left(keys, key)
+        end = bisect.bisect_right(keys, key)
+        i += bisect.bisect_right([str(b["version"]) for b in versions[i:end]], str(bundle["version"]))
+
+        keys.insert(i, key)
+        versions.insert(i, bundle)
+
+    def names(self):
+        return self.bundles.keys()
+
+    def versions(self, name):
+        """All the versions of a bundle, oldest first"""
+        return list(self.bundles.get(name, ()))
+
+    def latest(self, name, accept=None):
+        """
+        The latest version of a bundle, or the latest for which accept(bundle) is true, None if there isn't one.
+        accept is tried on the versions newest first, so finding the latest accepted version is a linear scan
+        of the versions newer than it. Whether a bundle is accepted (e.g. is compatible with an agent version)
+        needn't follow the order of the bundle versions, so it can't be bisected; use in_range when the
+        versions wanted are a range of bundle versions.
+        """
+        for bundle in reversed(self.bundles.get(name, ())):
+            if not accept or accept(bundle):
+                return bundle
+        return None
+
+    def get(self, name, version):
+        """
+        The bundle with the given version, or else the latest equal one (e.g. 10.2.0 for 10.2),
+        None if there isn't one
+        """
+        in_range = self.in_range(name, version, version)
+        for bundle in in_range:
+            if str(bundle["version"]) == str(version):
+                return bundle
+        return in_range[-1] if in_range else None
+
+    def in_range(self, name, low=None, high=None):
+        """The versions of a bundle from low to high inclusive, oldest first. Either end can be None for no limit."""
+        keys = self.keys.get(name, [])
+        start = bisect.bisect_left(keys, version_key(low)) if low is not None else 0
+        end = bisect.bisect_right(keys, version_key(high)) if high is not None else len(keys)
+        return self.bundles.get(name, [])[start:end]
+
+
 class AccEnv(object):
 
     """
@@ -741,6 +1660,44 @@ class GenericJsonObject(object):
     #     return self.__getitem__(name)
 
 
+class LazyList(list):
+
+    """
+    A list of lazily initialized FetchableJsonObject objects, as returned by
+    the AccApi *_many factories.
+
+    When an item is first accessed, it and the following items (up to --workers of
+    them) which have not been fetched yet are fetched in the background, so looping
+    over the list overlaps the requests rather than making them one after another.
+    """
+
+    def __init__(self, accapi, items):
+        super(LazyList, self).__init__(items)
+        self.accapi = accapi
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        item = super(LazyList, self).__getitem__(index)
+        if isinstance(index, (int, long)):
+            self.read_ahead(index)
+        return item
+
+    def read_ahead(self, index):
+        window = self.accapi.workers
+        if window <= 1:
+            return
+
+        if index < 0:
+            index += len(self)
+
+        pool = self.accapi.background_pool()
+        for item in super(LazyList, self).__getslice__(index, index + window):
+            item.prefetch(pool)
+
+
 class FetchableJsonObject(GenericJsonObject):
     """
     Add the ability to be able to fetch oneself based on ones key.
@@ -750,18 +1707,46 @@ class FetchableJsonObject(GenericJsonObject):
     def __init__(self, accapi, json_obj_or_item_id):
         super(FetchableJsonObject, self).__init__(accapi, None)
 
+        # The pending result of a background fetch of our json (see prefetch)
+        self.prefetching = None
+
+        # Whether the json only has some of the fields (see PagedJsonObject), the rest are fetched when needed
+        self.partial = False
+
         if isinstance(json_obj_or_item_id, dict):
             self.json = json_obj_or_item_id
             self.item_id = self.json["id"]
         else:
             self.item_id = json_obj_or_item_id
-            self.json_obj = None
+            self.json = None
 
     def get_json(self):
         if not self.json:
-            self.json = self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), self.item_id)
+            prefetching, self.prefetching = self.prefetching, None
+
+            if prefetching is not None:
+                self.json = prefetching.get()
+            else:
+                self.json = self.fetch_json()
         return self.json
 
+    def fetch_json(self):
+        return self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), self.item_id)
+
+    def __getitem__(self, key):
+        if self.partial and key not in self.get_json():
+            self.json = self.fetch_json()
+            self.partial = False
+        return super(FetchableJsonObject, self).__getitem__(key)
+
+    def prefetch(self, pool):
+        """
+        Start fetching our json on the given thread pool if we don't already have it.
+        get_json will pick up the result. See LazyList.
+        """
+        if not self.json and self.prefetching is None:
+            self.prefetching = pool.apply_async(self.fetch_json)
+
     def my_url(self):
         return self.my_name()
 
@@ -771,9 +1756,16 @@ class FetchableJsonObject(GenericJsonObject):
 
 class PagedJsonObject(GenericJsonObject):
 
-    def __init__(self, accapi, json_obj=None, **kwargs):
+    def __init__(self, accapi, json_obj=None, fields=None, **kwargs):
+        """
+        fields is an optional list of the json fields the caller is interested in.
+        Other fields (e.g. _links) are dropped as each page is read, so large scans
+        only keep what is needed. The id is always kept. Items with a key (e.g. Agent)
+        fetch all their json if asked for a field which was dropped.
+        """
         super(PagedJsonObject, self).__init__(accapi, json_obj, **kwargs)
         self.page = Page(json_obj)
+        self.fields = fields and frozenset(fields).union(["id"])
 
     # noinspection PyMethodOverriding
     def get_json(self, item_id, page=None):
@@ -805,11 +1797,29 @@ class PagedJsonObject(GenericJsonObject):
     def new_item(self, json_obj):
         return GenericJsonObject(self.accapi, json_obj)
 
+    def new_record(self, json_obj):
+        """Override this to return a compact JsonRecord (see records())"""
+        return self.new_item(json_obj)
+
+    def my_json_items(self):
+        items = self.json["_embedded"][self.my_name()]
+
+        if not self.fields:
+            return items
+
+        return [dict((key, value) for key, value in item.iteritems() if key in self.fields) for item in items]
+
     def my_items(self):
-        for item in self.json["_embedded"][self.my_name()]:
+        for item in self.my_json_items():
             x = self.new_item(item)
+            if self.fields and isinstance(x, FetchableJsonObject):
+                x.partial = True
             yield x
 
+    def my_records(self):
+        for item in self.my_json_items():
+            yield self.new_record(item)
+
     def __iter__(self):
         """
         Iterate over items, requesting one page at a time. Caller
@@ -817,6 +1827,21 @@ class PagedJsonObject(GenericJsonObject):
         If a page is specified in the keyword arguments then
         only that page of data is returned.
         """
+        return self._iterate_pages(self.my_items)
+
+    def json_items(self):
+        """Like iterating over the object, but yield the raw json of each item"""
+        return self._iterate_pages(self.my_json_items)
+
+    def records(self):
+        """
+        Like iterating over the object, but yield read-only JsonRecord objects
+        (e.g. AgentRecord) rather than the full json objects. Much cheaper when
+        scanning large numbers of agents.
+        """
+        return self._iterate_pages(self.my_records)
+
+    def _iterate_pages(self, page_items):
         page_specified = self.extra_args.get("page")
 
         if page_specified is None:
@@ -833,7 +1858,7 @@ class PagedJsonObject(GenericJsonObject):
             if not self.page.has_data():
                 break
 
-            for x in self.my_items():
+            for x in page_items():
                 yield x
 
             if page_specified or self.page.is_last_page():
@@ -895,6 +1920,9 @@ class Agents(PagedJsonObject):
     def new_item(self, json_obj):
         return Agent(self.accapi, json_obj)
 
+    def new_record(self, json_obj):
+        return AgentRecord(json_obj)
+
 
 class Agent(FetchableJsonObject):
 
@@ -963,6 +1991,9 @@ class Controllers(PagedJsonObject):
         c.json = json_obj
         return c
 
+    def new_record(self, json_obj):
+        return ControllerRecord(json_obj)
+
 
 class Controller(FetchableJsonObject):
 
@@ -1130,6 +2161,9 @@ class Bundles(PagedJsonObject):
     def new_item(self, json_obj):
         return Bundle(self.accapi, json_obj)
 
+    def new_record(self, json_obj):
+        return BundleRecord(json_obj)
+
 
 class Bundle(FetchableJsonObject):
 
@@ -1152,7 +2186,7 @@ class Bundle(FetchableJsonObject):
     def filename(self):
         return "%s-%s.tar.gz" % (self["name"], self["version"])
 
-    def download(self, directory=None, filename=None):
+    def download(self, directory=None, filename=None, verbose=True):
 
         if not filename:
             filename = self.filename()
@@ -1162,7 +2196,7 @@ class Bundle(FetchableJsonObject):
 
         if not os.path.exists(filename):
             res = self.accapi.http_get("/apm/acc/bundle", self.item_id, format="tar.gz")
-            write_content_to_file(res, filename)
+            write_content_to_file(res, filename, verbose=verbose)
 
         return filename
 
@@ -1182,10 +2216,8 @@ class Profile(FetchableJsonObject):
         return "bundle/%s/profile" % self.item_id
 
     # We have to override this as the parent class version will pass the item_id in which messes the derived url up.
-    def get_json(self):
-        if not self.json:
-            self.json = self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), None)
-        return self.json
+    def fetch_json(self):
+        return self.accapi.http_get_json("/apm/acc/%s" % self.my_url(), None)
 
 
 class Packages(PagedJsonObject):
@@ -1195,27 +2227,58 @@ class Packages(PagedJsonObject):
     def new_item(self, json_obj):
         return Package(self.accapi, json_obj)
 
+    def new_record(self, json_obj):
+        return PackageRecord(json_obj)
+
 
 class Package(FetchableJsonObject):
     def my_name(self):
         return "package"
 
-    def download(self, base_dir=".", archive_format="archive", filename=None, em_host="", overwrite=False):
+    def artifact_key(self, archive_format="archive", em_host=""):
+        """The ArtifactCache key for an archive of this package, None for drafts which are never cached"""
+        if self["draft"]:
+            # A draft can still be changed without getting a new version
+            return None
+        return "package/%s/%s/%s/%s" % (self.item_id, self["version"], archive_format, em_host)
 
-        print("Start initial download request")
+    def download(self, base_dir=".", archive_format="archive", filename=None, em_host="", overwrite=False,
+                 verbose=True):
+        """
+        Download the package archive into base_dir. Archives of packages which are not drafts are kept
+        in the ArtifactCache so the Config Server only has to build them once.
+        Pass verbose=False to not print progress, e.g. when several downloads are running at once.
+        """
+        return self.fetch_archive(base_dir, archive_format, filename, em_host, overwrite, verbose)[0]
 
-        # Pass a custom header
-        headers = self.accapi.headers.copy()
-        headers["accept"] = "application/x-tar"
-        res = self.accapi.http_get("/apm/acc/package", self.item_id, headers, format=archive_format, emHost=em_host)
+    def fetch_archive(self, base_dir=".", archive_format="archive", filename=None, em_host="", overwrite=False,
+                      verbose=True):
+        """As download, but returns (filename, from_cache)"""
 
-        if not filename:
-            filename = get_filename_from_content_disp(res)
+        def request():
+            if verbose:
+                print("Start initial download request")
 
-        filename = os.path.join(base_dir, filename)
-        write_content_to_file(res, filename, overwrite)
+            # Pass a custom header
+            headers = self.accapi.headers.copy()
+            headers["accept"] = "application/x-tar"
+            return self.accapi.http_get("/apm/acc/package", self.item_id, headers,
+                                        format=archive_format, emHost=em_host)
 
-        return filename
+        key = self.artifact_key(archive_format, em_host)
+
+        if not key:
+            res = request()
+            filename = os.path.join(base_dir, filename or get_filename_from_content_disp(res))
+            write_content_to_file(res, filename, overwrite, verbose=verbose)
+            return filename, False
+
+        def download(temp_path):
+            res = request()
+            write_content_to_file(res, temp_path, True, verbose=verbose)
+            return get_filename_from_content_disp(res)
+
+        return self.accapi.artifact_cache().fetch(key, base_dir, filename, download, overwrite, verbose)
 
     def required_bundles(self):
         bundles = self.accapi.http_get_json("/apm/acc/package", "%s/%s" % (self.item_id, "requiredBundles"))
@@ -1254,6 +2317,530 @@ class Package(FetchableJsonObject):
 
         res, json_obj = self.accapi.http_patch("/apm/acc/package/" + str(self.item_id), json.dumps(body))
 
+    def edit(self, bundle_ids=None):
+        """Return a PackageEdit for making changes to this package in a single request"""
+        return PackageEdit(self, bundle_ids)
+
+
+class PackageEdit(object):
+
+    """
+    Collects changes to the bundles and overrides of a package and applies them in a
+    single PATCH, or none at all if they would leave the package as it is:
+
+        edit = package.edit()
+        edit.add_bundles([12, 13])
+        edit.bundle_overrides.setdefault("tomcat", {})["preamble"] = "Tuned for production"
+        edit.apply()
+
+    bundle_overrides starts as a copy of the package's bundleOverrides and is edited in place
+    (or replaced). The bundles the package currently includes are only fetched if the bundles
+    are changed, unless they are passed in as bundle_ids. As with Package.add_bundles, changing
+    the bundles also means the package stops being a draft unless set_draft(True) is called.
+    """
+
+    def __init__(self, package, bundle_ids=None):
+        self.package = package
+        self.bundle_overrides = copy.deepcopy(package["bundleOverrides"] or {})
+        self.current_bundle_ids = bundle_ids and [str(b) for b in bundle_ids]
+        self.bundle_ids = None
+        self.added = []
+        self.removed = []
+        self.draft = None
+
+    def set_bundles(self, bundle_ids):
+        """Replace the bundles of the package, in the given order"""
+        self.bundle_ids = [str(b) for b in bundle_ids]
+        self.added = []
+        self.removed = []
+
+    def add_bundles(self, bundle_ids):
+        self.added.extend(str(b) for b in bundle_ids)
+
+    def remove_bundles(self, bundle_ids):
+        self.removed.extend(str(b) for b in bundle_ids)
+
+    def set_draft(self, draft):
+        self.draft = draft
+
+    def bundles_changed(self):
+        return self.bundle_ids is not None or self.added or self.removed
+
+    def wanted_bundle_ids(self, current):
+        bundle_ids = list(self.bundle_ids if self.bundle_ids is not None else current)
+        bundle_ids.extend(b for b in self.added if b not in bundle_ids)
+        return [b for b in bundle_ids if b not in self.removed]
+
+    def body(self):
+        """Return the body of the PATCH for the changes, None if nothing would change"""
+        body = {}
+
+        if self.bundles_changed():
+            if self.current_bundle_ids is None:
+                self.current_bundle_ids = [str(b["id"]) for b in self.package.bundles()]
+
+            wanted = self.wanted_bundle_ids(self.current_bundle_ids)
+
+            # Bundles set with set_bundles are sent in that order, so a new order is a change too
+            if self.bundle_ids is not None:
+                changed = wanted != self.current_bundle_ids
+            else:
+                changed = set(wanted) != set(self.current_bundle_ids)
+
+            if changed:
+                body["bundles"] = ["bundle/%s" % b for b in wanted]
+                body["draft"] = bool(self.draft)
+
+        if self.draft is not None and self.draft != self.package["draft"]:
+            body["draft"] = self.draft
+
+        if self.bundle_overrides != (self.package["bundleOverrides"] or {}):
+            body["bundleOverrides"] = self.bundle_overrides
+
+        return body or None
+
+    def apply(self):
+        """Send the changes to the Config Server. Returns False if there was nothing to change."""
+        body = self.body()
+
+        if not body:
+            return False
+
+        res, json_obj = self.package.accapi.http_patch("/apm/acc/package/" + str(self.package.item_id),
+                                                       json.dumps(body))
+
+        # The response is the updated package
+        self.package.json = json_obj
+
+        if "bundles" in body:
+            self.current_bundle_ids = self.wanted_bundle_ids(self.current_bundle_ids)
+            self.bundle_ids = None
+            self.added = []
+            self.removed = []
+
+        return True
+
+
+def apply_package_edits(edits, workers=WORKERS):
+    """
+    Apply many PackageEdits concurrently, each in at most one request.
+    Returns whether each package was changed, in the same order as the edits.
+    """
+    return parallel_map(lambda edit: edit.apply(), edits, workers)
+
+
+class OverrideSet(object):
+
+    """
+    An indexed view of the bundleOverrides of a package (bundle name -> {"preamble": ..., "properties": [...]}),
+    which is edited in place, e.g. PackageEdit.bundle_overrides.
+
+    There is at most one override of a property in each bundle. Overriding a property again updates
+    the existing override rather than adding another, and duplicates already in the overrides are
+    merged (the last one wins). Overrides are looked up by bundle and property name, so working out
+    the overrides for a profile takes time proportional to the number of properties.
+    """
+
+    default_bundle = "java-agent"
+
+    def __init__(self, bundle_overrides):
+        self.bundle_overrides = bundle_overrides
+
+        # (bundle name, property name) -> override
+        self.index = {}
+
+        for bundle_name, overrides in bundle_overrides.iteritems():
+            properties = (overrides or {}).get("properties") or []
+            unique = []
+
+            for prop in properties:
+                existing = self.index.get((bundle_name, prop["name"]))
+                if existing:
+                    existing.update(prop)
+                else:
+                    self.index[(bundle_name, prop["name"])] = prop
+                    unique.append(prop)
+
+            if len(unique) != len(properties):
+                overrides["properties"] = unique
+
+    def get(self, bundle_name, name):
+        """Return the override of a property in a bundle, None if there isn't one"""
+        return self.index.get((bundle_name, name))
+
+    def bundle(self, bundle_name):
+        """Return the overrides of a bundle, creating them if necessary"""
+        overrides = self.bundle_overrides.get(bundle_name)
+
+        if not overrides:
+            overrides = self.bundle_overrides[bundle_name] = {"preamble": None, "properties": []}
+        elif overrides.get("properties") is None:
+            overrides["properties"] = []
+
+        return overrides
+
+    def set_preamble(self, bundle_name, preamble):
+        self.bundle(bundle_name)["preamble"] = preamble
+
+    def override(self, bundle_name, name, value, hidden=False, user_key=None, description=None):
+        """
+        Override a property in a bundle. An existing override keeps its userKey and description
+        unless new ones are given. Returns False if the override was already there as asked.
+        """
+        existing = self.get(bundle_name, name)
+
+        if existing:
+            wanted = dict(existing, value=value, hidden=hidden)
+            if user_key is not None:
+                wanted["userKey"] = user_key
+            if description is not None:
+                wanted["description"] = description
+
+            if wanted == existing:
+                return False
+
+            existing.update(wanted)
+        else:
+            prop = {"description": description,
+                    "hidden": hidden,
+                    "name": name,
+                    "value": value,
+                    "userKey": user_key}
+
+            self.bundle(bundle_name)["properties"].append(prop)
+            self.index[(bundle_name, name)] = prop
+
+        return True
+
+    def remove(self, bundle_name, name):
+        """Remove the override of a property in a bundle. Returns False if there wasn't one."""
+        prop = self.index.pop((bundle_name, name), None)
+
+        if not prop:
+            return False
+
+        self.bundle_overrides[bundle_name]["properties"].remove(prop)
+        return True
+
+    @staticmethod
+    def property_map(properties):
+        """Map property name -> property for the properties of a bundle, preferring visible properties"""
+        property_map = {}
+        for prop in properties:
+            if not prop["hidden"] or prop["name"] not in property_map:
+                property_map[prop["name"]] = prop
+        return property_map
+
+    def require(self, wanted, bundles, owners=None):
+        """
+        Override the properties of the bundles so the package has each of the properties in wanted
+        (name -> value) visible and with that value. Properties which aren't in a bundle are added
+        to the default bundle, with userKey "+" as for new properties.
+
+        bundles is a list of (bundle name, properties of the bundle as from BundlePropertyIndex).
+        owners maps a property name to the name of the bundle that should provide it, by default it
+        is the first of the bundles with the property.
+
+        Returns a list of (action, bundle name, property name, value, property in the bundle) for the
+        changes made, action being "override", "add" or "remove" (an earlier override is not needed).
+        """
+        property_maps = dict((bundle_name, self.property_map(properties)) for bundle_name, properties in bundles)
+
+        if owners is None:
+            owners = {}
+            for bundle_name, properties in reversed(bundles):
+                for prop in properties:
+                    owners[prop["name"]] = bundle_name
+
+        changes = []
+
+        for name, value in wanted.iteritems():
+            owner = owners.get(name)
+            base = property_maps.get(owner, {}).get(name)
+
+            if not base:
+                if self.override(self.default_bundle, name, value, user_key="+"):
+                    changes.append(("add", self.default_bundle, name, value, None))
+
+            elif value != (base["value"] or "") or base["hidden"]:
+                if self.override(owner, name, value, user_key=base["key"]):
+                    changes.append(("override", owner, name, value, base))
+
+            elif self.remove(owner, name):
+                changes.append(("remove", owner, name, value, base))
+
+        return changes
+
+    def hide_others(self, wanted, bundles, ignored=()):
+        """
+        Hide the visible properties of the bundles which aren't in wanted (a collection of
+        property names) or in ignored. Returns a list of changes as for require, with action "hide".
+        """
+        changes = []
+
+        for bundle_name, properties in bundles:
+            for prop in properties:
+                if prop["hidden"] or prop["name"] in wanted or prop["name"] in ignored:
+                    continue
+
+                value = prop["value"] or ""
+                if self.override(bundle_name, prop["name"], value, hidden=True):
+                    changes.append(("hide", bundle_name, prop["name"], value, prop))
+
+        return changes
+
+
+def utf8(value):
+    """Convert any unicode in a value decoded from json to UTF-8 encoded strings"""
+    if isinstance(value, unicode):
+        return value.encode("UTF-8")
+    elif isinstance(value, dict):
+        return dict((utf8(k), utf8(v)) for k, v in value.iteritems())
+    elif isinstance(value, list):
+        return [utf8(v) for v in value]
+    return value
+
+
+class JsonRecord(object):
+
+    """
+    A compact, read-only alternative to the FetchableJsonObject classes for
+    scanning large numbers of items (see PagedJsonObject.records()).
+
+    Only the fields named in __slots__ are kept, everything else (e.g. _links) is
+    dropped. Strings are converted to UTF-8 once when the record is created rather
+    than on every access, and the values of the fields named in interned (things
+    like osName which repeat over and over) are shared between records.
+    Missing fields are None.
+
+    Fields can be accessed as attributes (agent.osName) or with the index
+    operator (agent["osName"]) so records can be used in place of the json objects.
+    """
+
+    __slots__ = ()
+    interned = frozenset()
+
+    def __init__(self, json_obj):
+        for field in self.__slots__:
+            value = json_obj.get(field)
+            if isinstance(value, unicode):
+                value = value.encode("UTF-8")
+                if field in self.interned:
+                    value = intern(value)
+            elif isinstance(value, (dict, list)):
+                value = utf8(value)
+            setattr(self, field, value)
+
+    def get_json(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    def __str__(self):
+        return pprint.PrettyPrinter(indent=2).pformat(self.get_json())
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            print("ERROR: Missing key %s.  Fields available in the %s are:\n%s" % (
+                key, type(self).__name__, ", ".join(self.__slots__)))
+            raise KeyError(key)
+        return getattr(self, key)
+
+
+class AgentRecord(JsonRecord):
+    __slots__ = ("id", "agentName", "processName", "serverName", "osName", "appServerName", "appServerVersion",
+                 "status", "logLevel", "metricCount", "version", "registrationTimestamp", "packageDetails")
+    interned = frozenset(("processName", "osName", "appServerName", "appServerVersion", "status", "logLevel",
+                          "version"))
+
+
+class ControllerRecord(JsonRecord):
+    __slots__ = ("id", "serverName", "osName", "osVersion", "version", "available")
+    interned = frozenset(("osName", "osVersion", "version"))
+
+
+class BundleRecord(JsonRecord):
+    __slots__ = ("id", "name", "version", "displayName", "agentVersion", "facets", "dependencies", "compatibility")
+    interned = frozenset(("name", "version", "displayName", "agentVersion"))
+
+
+class PackageRecord(JsonRecord):
+    __slots__ = ("id", "packageName", "version", "totalAgentsForPackage", "totalAgentsForVersion", "modified",
+                 "latest", "latestPackageID", "draft", "downloaded")
+    interned = frozenset(("packageName", "version"))
+
+
+class DictColumn(object):
+
+    """
+    A dictionary encoded column of an AgentTable. Each distinct value is stored
+    once and the rows hold an integer code which indexes the values.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = array.array("l")
+        self.lookup = {}
+
+    def append(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, row):
+        return self.values[self.codes[row]]
+
+
+class AgentTable(object):
+
+    """
+    Agent meta-data held in columns rather than as an object per agent, for fast
+    analysis of large numbers of agents (see AccApi.agent_table).
+
+    Numeric columns are arrays, string columns are dictionary encoded (see DictColumn),
+    so 100k agents take a few megabytes. The package columns are taken from the agent
+    packageDetails and are None for agents which have no package.
+
+    where() returns a new table which shares the columns with this one but only
+    includes the matching rows, so filters can be chained, e.g.
+
+        table.where("osName", "Linux").where("packageLatest", False).group_count("packageVersion")
+
+    Agents are grouped by serverName to get per-controller figures as there is a single
+    controller per machine.
+    """
+
+    numeric_columns = (("id", "l"), ("metricCount", "l"), ("registrationTimestamp", "d"))
+
+    dict_columns = ("serverName", "processName", "osName", "appServerName", "appServerVersion", "status", "version")
+
+    package_columns = (("packageId", "id"), ("packageVersion", "version"), ("packageLatest", "latest"))
+
+    def __init__(self, agents_json=(), columns=None, rows=None):
+        """Build the table from an iterable of agent json objects"""
+
+        self.rows = rows
+
+        if columns is not None:
+            self.columns = columns
+            return
+
+        self.columns = {}
+        for name, typecode in self.numeric_columns:
+            self.columns[name] = array.array(typecode)
+        for name in self.dict_columns:
+            self.columns[name] = DictColumn()
+        for name, key in self.package_columns:
+            self.columns[name] = DictColumn()
+
+        for agent in agents_json:
+            self.append(agent)
+
+    def append(self, agent):
+        columns = self.columns
+
+        columns["id"].append(int(agent.get("id") or 0))
+        columns["metricCount"].append(int(agent.get("metricCount") or 0))
+        columns["registrationTimestamp"].append(parse_timestamp(agent.get("registrationTimestamp")))
+
+        for name in self.dict_columns:
+            columns[name].append(utf8(agent.get(name)))
+
+        package_details = agent.get("packageDetails") or {}
+        for name, key in self.package_columns:
+            columns[name].append(utf8(package_details.get(key)))
+
+    def _selected(self, column):
+        """The column values (or codes of a DictColumn) for the rows in the table"""
+        if isinstance(column, DictColumn):
+            column = column.codes
+        if self.rows is None:
+            return column
+        return array.array(column.typecode, itertools.imap(column.__getitem__, self.rows))
+
+    def _row_numbers(self):
+        if self.rows is None:
+            return xrange(len(self.columns["id"]))
+        return self.rows
+
+    def count(self):
+        return len(self._row_numbers())
+
+    def __len__(self):
+        return self.count()
+
+    def column(self, name):
+        """Return a list of the values of the named column for the rows in the table"""
+        column = self.columns[name]
+        if isinstance(column, DictColumn):
+            return [column.values[code] for code in self._selected(column)]
+        return self._selected(column).tolist()
+
+    def where(self, name, *values):
+        """Return a table of the rows where the named column has any of the given values"""
+        column = self.columns[name]
+
+        if isinstance(column, DictColumn):
+            wanted = set(column.lookup[value] for value in values if value in column.lookup)
+        else:
+            wanted = set(values)
+
+        mask = itertools.imap(wanted.__contains__, self._selected(column))
+        return self._with_rows(itertools.compress(self._row_numbers(), mask))
+
+    def where_between(self, name, low=None, high=None):
+        """Return a table of the rows where the named numeric column is >= low and < high"""
+        if low is None:
+            low = float("-inf")
+        if high is None:
+            high = float("inf")
+
+        mask = (low <= value < high for value in self._selected(self.columns[name]))
+        return self._with_rows(itertools.compress(self._row_numbers(), mask))
+
+    def _with_rows(self, rows):
+        return AgentTable(columns=self.columns, rows=array.array("l", rows))
+
+    def group_count(self, name):
+        """Return a dictionary of the number of rows for each value of the named column"""
+        column = self.columns[name]
+        values = self._selected(column)
+
+        if isinstance(column, DictColumn) and len(column.values) <= 32:
+            # array.count is a C loop so one pass per distinct value is quick for
+            # the low cardinality columns such as osName we normally group on
+            counts = dict((column.values[code], values.count(code)) for code in xrange(len(column.values)))
+            return dict((value, count) for value, count in counts.iteritems() if count)
+
+        counts = {}
+        for value in values:
+            counts[value] = counts.get(value, 0) + 1
+
+        if isinstance(column, DictColumn):
+            return dict((column.values[code], count) for code, count in counts.iteritems())
+        return counts
+
+    def group_sum(self, name, value_name):
+        """Return a dictionary of the sum of the numeric column value_name for each value of column name"""
+        column = self.columns[name]
+
+        totals = {}
+        for key, value in itertools.izip(self._selected(column), self._selected(self.columns[value_name])):
+            totals[key] = totals.get(key, 0) + value
+
+        if isinstance(column, DictColumn):
+            return dict((column.values[code], total) for code, total in totals.iteritems())
+        return totals
+
+    def sum(self, value_name):
+        return sum(self._selected(self.columns[value_name]))
+
 
 class AccCommandLineApp(object):
 
@@ -1298,6 +2885,10 @@ class AccCommandLineApp(object):
         self.parser_group.add_argument(
             '--page-size', dest='page_size', action='store', default=PAGE_SIZE, type=int, help='page size for multi-page requests')
 
+        self.parser_group.add_argument(
+            '--workers', dest='workers', action='store', default=WORKERS, type=int,
+            help='maximum number of concurrent requests to make to the Config Server')
+
     def run(self):
         self.build_arg_parser()
         self.args = self.parser.parse_args()
@@ -1318,8 +2909,11 @@ class AccCommandLineApp(object):
 
         token = self.acc_env.get_can_be_empty("token")
 
-        self.acc = AccApi(server, token, self.args.page_size)
-        self.main()
+        self.acc = AccApi(server, token, self.args.page_size, self.args.workers)
+        try:
+            self.main()
+        finally:
+            self.acc.close()
 
         # This code is to suppress "close failed in file object destructor" error and
         # IOError: [Errno 32] Broken pipe